@@ -44,8 +44,9 @@ from .freetime import FreeTime
 from .sampling_method import FreeGrid, UniformGrid, GeometricGrid
 from .grouping_techniques import LseGroup
 from .solution import OcpSolution
+from .mpc import MPCRunner, RTIRunner
 from .external.manager import external_method
-from .casadi_helpers import rockit_pickle_context, rockit_unpickle_context
+from .casadi_helpers import rockit_pickle_context, rockit_unpickle_context, set_debug_meta
 
 
 try:
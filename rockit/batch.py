@@ -0,0 +1,137 @@
+#
+#     This file is part of rockit.
+#
+#     rockit -- Rapid Optimal Control Kit
+#     Copyright (C) 2019 MECO, KU Leuven. All rights reserved.
+#
+#     Rockit is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU Lesser General Public
+#     License as published by the Free Software Foundation; either
+#     version 3 of the License, or (at your option) any later version.
+#
+#     Rockit is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#     Lesser General Public License for more details.
+#
+#     You should have received a copy of the GNU Lesser General Public
+#     License along with CasADi; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+#
+
+from casadi import Function, Opti, nlpsol, jacobian, vec, vcat, vertcat, vertsplit, DM, MX
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from numpy import nan
+
+from .mpc import MPCRunner
+
+
+class BatchSolver:
+    """Solve one transcribed Ocp for many parameter values and initial guesses
+
+    All symbolic work is done once. An instance amounts to filling in numerical vectors
+    and a call to a dedicated solver instance.
+    Instances can be spread over a pool of worker processes,
+    which each receive the solver once.
+    """
+    def __init__(self, ocp, parameters, initials, results):
+        """
+        Parameters
+        ----------
+        ocp : :obj:`~rockit.ocp.Ocp`
+            Optimal control problem
+        parameters : list of :obj:`~casadi.MX`
+            Parameters that vary between instances
+        initials : list of :obj:`~casadi.MX`
+            Expressions of decision variables, e.g. ocp.sample(x, grid='control')[1],
+            of which the initial guess varies between instances
+        results : dict
+            Expressions to evaluate at each solution, keyed by name
+        """
+        stage = ocp._transcribed
+        method = stage._method
+        opti = method.opti
+        if not opti._solver_args:
+            raise Exception("You forgot to declare a solver. Use e.g. ocp.solver('ipopt').")
+
+        advanced = opti.advanced
+        advanced.bake()
+        self.solver = nlpsol("solver", *opti._solver_args[:1], {"x": advanced.x, "p": advanced.p, "f": advanced.f, "g": advanced.g}, *opti._solver_args[1:])
+        args = [advanced.x, advanced.p]
+        values = DM(advanced.value(vertcat(*args), Opti.initial(opti)+Opti.value_parameters(opti)))
+        self.x0, self.p = [np.array(e).ravel() for e in vertsplit(values, np.cumsum([0]+[e.numel() for e in args]).tolist())]
+        self.bounds = Function("bounds", [advanced.p], [advanced.lbg, advanced.ubg])
+
+        self.p_index = [MPCRunner._positions(vcat([vec(e) for e in method.parameter_symbols(stage, p)]), advanced.p) for p in parameters]
+
+        # Decision variables may be scaled: expr = scale*variable
+        self.x_index = []
+        self.x_scale = []
+        for e in initials:
+            e = vec(stage.value(MX(e)))
+            index = MPCRunner._positions(e, advanced.x)
+            if np.any(index<0):
+                raise Exception("An initial guess can only be given for expressions that select decision variables.")
+            J = Function("J", [advanced.x], [jacobian(e, advanced.x)])(self.x0)
+            self.x_index.append(index)
+            self.x_scale.append(np.array([float(J[i, j]) for i, j in enumerate(index)]))
+
+        self.names = list(results.keys())
+        exprs = [MX(stage.value(MX(results[name]))) for name in self.names]
+        self.shapes = [e.shape for e in exprs]
+        self.results = Function("results", [advanced.x, advanced.p], exprs)
+
+    def instance(self, p_values, x_values):
+        """Numerical parameter vector and initial guess of one instance"""
+        p = np.array(self.p)
+        for index, v in zip(self.p_index, p_values):
+            p[index] = np.array(vec(DM(v))).ravel()
+        x0 = np.array(self.x0)
+        for index, scale, v in zip(self.x_index, self.x_scale, x_values):
+            x0[index] = np.array(vec(DM(v))).ravel()/scale
+        return p, x0
+
+    def solve(self, p, x0):
+        """Solve one instance, returns (results, stats)"""
+        try:
+            lbg, ubg = self.bounds(p)
+            res = self.solver(x0=x0, p=p, lbg=lbg, ubg=ubg)
+            stats = self.solver.stats()
+            return [np.array(r) for r in self.results.call([res["x"], DM(p)])], stats
+        except Exception as e:
+            return None, {"success": False, "return_status": "Exception", "error": str(e)}
+
+    def __call__(self, param_table, initial_table, workers=1):
+        n = None
+        for v in list(param_table)+list(initial_table):
+            if n is None: n = len(v)
+            if len(v)!=n:
+                raise Exception("All tables must have the same number of instances.")
+        if n is None:
+            raise Exception("Cannot determine the number of instances: supply at least one parameter or initial guess column.")
+        instances = [self.instance([v[i] for v in param_table], [v[i] for v in initial_table]) for i in range(n)]
+
+        if workers>1 and n>1:
+            with ProcessPoolExecutor(max_workers=min(workers, n), initializer=_init_worker, initargs=(self,)) as pool:
+                solutions = list(pool.map(_solve_worker, instances, chunksize=max(1, n//(4*workers))))
+        else:
+            solutions = [self.solve(*e) for e in instances]
+
+        ret = {}
+        for k, (name, shape) in enumerate(zip(self.names, self.shapes)):
+            stacked = np.full((n,)+shape, nan)
+            for i, (res, _) in enumerate(solutions):
+                if res is not None: stacked[i] = res[k].reshape(shape)
+            ret[name] = stacked.reshape((n,)+tuple([d for d in shape if d!=1]))
+        return ret, [stats for _, stats in solutions]
+
+_worker = None
+
+def _init_worker(batch):
+    global _worker
+    _worker = batch
+
+def _solve_worker(instance):
+    return _worker.solve(*instance)
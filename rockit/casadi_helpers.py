@@ -24,6 +24,7 @@ import casadi as cs
 from casadi import *
 from collections import defaultdict, OrderedDict
 from contextlib import contextmanager
+from bisect import bisect_right
 
 def get_ranges_dict(list_expr):
     ret = HashDict()
@@ -101,14 +102,47 @@ def reinterpret_expr(expr, symbols_from, symbols_to):
     return output_val[0]
 
 
-def get_meta(base=None):
+# Capture stack traces as meta data of variables and constraints, unless overridden per Ocp
+_debug_meta = True
+# Interned stack trace entries, keyed by (filename, line, function name)
+_frames = {}
+
+def set_debug_meta(flag):
+    """Globally enable or disable stack traces in meta data
+
+    Stack traces map variables and constraints back to source lines in error messages
+    and in the Opti debug interface.
+    They take time and memory for problems with many constraints.
+
+    Parameters
+    ----------
+    flag : bool
+        Default for all Ocps that do not specify debug_meta themselves
+    """
+    global _debug_meta
+    _debug_meta = bool(flag)
+
+def debug_meta(debug=None):
+    """Resolve a per-Ocp debug_meta setting against the global default"""
+    return _debug_meta if debug is None else debug
+
+def _frame_entry(frame):
+    code = frame.f_code
+    key = (code.co_filename, frame.f_lineno, code.co_name)
+    entry = _frames.get(key)
+    if entry is None:
+        import os
+        entry = _frames[key] = {"file":os.path.abspath(code.co_filename),"line":frame.f_lineno,"name":code.co_name}
+    return entry
+
+def get_meta(base=None, debug=None):
     if base is not None: return base
     # Construct meta-data
+    if not debug_meta(debug):
+        return {"stacktrace": []}
     import sys
-    import os
     try:
-        frame = sys._getframe(2)
-        meta = {"stacktrace": [{"file":os.path.abspath(frame.f_code.co_filename),"line":frame.f_lineno,"name":frame.f_code.co_name} ] }
+        meta = {"stacktrace": [_frame_entry(sys._getframe(2))]}
     except:
         meta = {"stacktrace": []}
     return meta
@@ -118,14 +152,15 @@ def merge_meta(a, b):
         return a
     if a is None:
         return b
-    from copy import deepcopy
-    res = deepcopy(a)
-    res["stacktrace"] += b["stacktrace"] 
+    # Stack trace entries are interned and never modified
+    res = dict(a)
+    res["stacktrace"] = a["stacktrace"] + b["stacktrace"]
     return res
 
 def single_stacktrace(m):
-    from copy import deepcopy
-    m = deepcopy(m)
+    if not m["stacktrace"]:
+        return None
+    m = dict(m)
     m["stacktrace"] = m["stacktrace"][0]
     return m
 
@@ -149,6 +184,14 @@ def DM2numpy(dm, expr_shape, tdim=None):
     res = res.reshape(target_shape)
     return res
 
+def DM2native(dm):
+    """Convert to float or numpy array, like casadi.Opti.value does"""
+    if dm.numel()==1:
+        return float(dm)
+    if dm.is_vector():
+        return np.array(dm).ravel()
+    return np.array(dm)
+
 class HashWrap:
     def __init__(self, arg):
         assert not isinstance(arg,HashWrap)
@@ -265,6 +308,48 @@ class HashOrderedDict(OrderedDict):
             r[k] = v
         return r
 
+class BlockList:
+    """Sequence of equally-shaped matrices, stored as horizontally concatenated chunks
+
+    Entries are column slices of the chunks, created on access.
+    hcat() returns the concatenation of all entries without splitting and re-joining.
+    """
+    def __init__(self):
+        self._chunks = []
+        self._offsets = [0]
+        self.block_shape = None
+    def append(self, block):
+        self.extend_blocks(block, 1)
+    def extend_blocks(self, chunk, n):
+        """Add n entries, given side by side in chunk"""
+        shape = (chunk.shape[0], chunk.shape[1]//n)
+        if self.block_shape is None:
+            self.block_shape = shape
+        assert shape==self.block_shape and chunk.shape[1]==n*shape[1]
+        self._chunks.append(chunk)
+        self._offsets.append(self._offsets[-1]+n)
+    def __len__(self):
+        return self._offsets[-1]
+    def __bool__(self):
+        return len(self)>0
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(len(self)))]
+        if k<0: k+= len(self)
+        if k<0 or k>=len(self):
+            raise IndexError("BlockList index out of range")
+        c = bisect_right(self._offsets, k)-1
+        w = self.block_shape[1]
+        i = k-self._offsets[c]
+        return self._chunks[c][:, i*w:(i+1)*w]
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+    def hcat(self):
+        if len(self._chunks)==1:
+            return self._chunks[0]
+        return hcat(self._chunks)
+
 
 def for_all_primitives(expr, rhs, callback, msg, rhs_type=MX):
     if expr.is_symbolic():
@@ -120,6 +120,9 @@ class DirectCollocation(SamplingMethod):
 
         self.add_variables_V_control_finalize(stage, opti)
 
+    def interval_variables(self):
+        return SamplingMethod.interval_variables(self) + [(self.X, 1), ([hcat(e) for e in self.Xc], 1), ([hcat(e) for e in self.Zc], 1)]
+
     def add_constraints(self, stage, opti):
         scale_x = stage._scale_x
         scale_der_x = stage._scale_der_x
@@ -186,39 +189,28 @@ class DirectCollocation(SamplingMethod):
                     self.q = self.q + res["quad"]*dt*self.B[j]
                     if stage.nz:
                         opti.subject_to(0 == res["alg"], scale = scale_z)
-                    for c, meta, args in stage._constraints["integrator_roots"]:
-                        opti.subject_to(self.eval_at_integrator_root(stage, c, k, i, j), scale=args["scale"], meta=meta)
+                    self.add_constraints_integrator_root(stage, opti, k, i, j, stage._constraints)
 
                 # Continuity constraints
                 x_next = self.X[k + 1] if i==self.M-1 else self.Xc[k][i+1][:,0]
                 opti.subject_to(mtimes(self.Xc[k][i],self.D) == x_next, scale=scale_x)
 
-                for c, meta, args in stage._constraints["integrator"]:
-                    if k==0 and i==0 and not args["include_first"]: continue
-                    opti.subject_to(self.eval_at_integrator(stage, c, k, i), scale=args["scale"], meta=meta)
-                for c, meta, _ in stage._constraints["inf"]:
-                    self.add_inf_constraints(stage, opti, c, k, i, meta)
-
-            for c, meta, args in stage._constraints["control"]:  # for each constraint expression
-                if k==0 and not args["include_first"]: continue
-                # Add it to the optimizer, but first make x,u concrete.
-                try:
-                    opti.subject_to(self.eval_at_control(stage, c, k), scale=args["scale"], meta=meta)
-                except IndexError:
-                    pass # Can be caused by ocp.offset -> drop constraint
-
-        for c, meta, args in stage._constraints["control"]:  # for each constraint expression
-            if not args["include_last"]: continue
-            # Add it to the optimizer, but first make x,u concrete.
-            try:
-                opti.subject_to(self.eval_at_control(stage, c, -1), scale=args["scale"], meta=meta)
-            except IndexError:
-                pass # Can be caused by ocp.offset -> drop constraint
-
-        for c, meta, args in stage._constraints["integrator"]:  # for each constraint expression
-            if not args["include_last"]: continue
-            # Add it to the optimizer, but first make x,u concrete.
-            opti.subject_to(self.eval_at_control(stage, c, -1), scale=args["scale"], meta=meta)
+                self.add_constraints_integrator(stage, opti, k, i, stage._constraints)
+
+            self.add_constraints_control(stage, opti, k, stage._constraints)
+
+        self.add_constraints_last(stage, opti, stage._constraints)
+
+    def add_constraints_integrator_root(self, stage, opti, k, i, j, constraints):
+        for c, meta, args in constraints["integrator_roots"]:
+            opti.subject_to(self.eval_at_integrator_root(stage, c, k, i, j), scale=args["scale"], meta=meta)
+
+    def add_constraints_interval(self, stage, opti, k, constraints):
+        for i in range(self.M):
+            for j in range(self.degree):
+                self.add_constraints_integrator_root(stage, opti, k, i, j, constraints)
+            self.add_constraints_integrator(stage, opti, k, i, constraints)
+        self.add_constraints_control(stage, opti, k, constraints)
 
     def set_initial(self, stage, master, initial):
         opti = master.opti if hasattr(master, 'opti') else master
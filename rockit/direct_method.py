@@ -20,10 +20,13 @@
 #
 #
 
-from casadi import Opti, jacobian, dot, hessian, symvar, evalf, veccat, DM, vertcat, is_equal
+from casadi import Opti, jacobian, dot, hessian, symvar, evalf, veccat, DM, vertcat, vertsplit, is_equal, reshape, Function
 import casadi
 import numpy as np
-from .casadi_helpers import get_meta, merge_meta, single_stacktrace, MX
+import hashlib
+import os
+from collections import OrderedDict
+from .casadi_helpers import get_meta, merge_meta, single_stacktrace, debug_meta, MX
 from .solution import OcpSolution
 from .freetime import FreeTime
 
@@ -32,9 +35,16 @@ class DirectMethod:
     Base class for 'direct' solution methods for Optimal Control Problems:
       'first discretize, then optimize'
     """
+    # Can stage constraints and objective be re-emitted into an existing transcription?
+    incremental = True
+    # Solvers that exploit a stage-wise (optimal control) structure of the NLP
+    stagewise_solvers = ['fatrop']
+
     def __init__(self):
         self._solver = None
         self._solver_options = None
+        self._solver_cache = False
+        self._solver_cache_dir = None
         self._callback = None
         self.artifacts = []
         self.clean()
@@ -114,7 +124,17 @@ class DirectMethod:
             if self.solver is not None:
                 if self._solver is None:
                     raise Exception("You forgot to declare a solver. Use e.g. ocp.solver('ipopt').")
-                self.opti.solver(self._solver, self._solver_options)
+                solver_options = self._solver_options
+                if self._solver_cache_dir is not None and solver_options.get("jit", False) and "jit_serialize" not in solver_options:
+                    # Store the compiled binary alongside the solver, such that a load needs no compiler
+                    solver_options = dict(solver_options, jit_serialize="embed")
+                if self.stagewise and "structure_detection" not in solver_options:
+                    # Stage-wise variable and constraint ordering is guaranteed by the transcription
+                    solver_options = dict(solver_options, structure_detection="auto")
+                self.opti.solver(self._solver, solver_options)
+                if (self._solver_cache or self._solver_cache_dir is not None) and not self._callback:
+                    self.opti.solver_cache = solver_cache
+                    self.opti.solver_cache_dir = self._solver_cache_dir
         if phase==2:
             self.opti.transcribe_placeholders(phase, kwargs["placeholders"])
 
@@ -126,12 +146,18 @@ class DirectMethod:
         self.add_variables(stage, self.opti)
         self.add_parameters(stage, self.opti)
 
-        for c, m, _ in stage._constraints["point"]:
-            self.opti.subject_to(self.eval_top(stage, c), meta = m)
-        self.opti.add_objective(self.eval_top(stage, stage._objective))
+        self.add_stage_constraints(stage, self.opti, stage._constraints)
+        self.add_objective(stage, self.opti)
         self.set_initial(stage, self.opti, stage._initial)
         self.set_parameter(stage, self.opti)
 
+    def add_stage_constraints(self, stage, opti, constraints):
+        for c, m, _ in constraints["point"]:
+            opti.subject_to(self.eval_top(stage, c), meta = m)
+
+    def add_objective(self, stage, opti):
+        opti.add_objective(self.eval_top(stage, stage._objective))
+
     def set_initial(self, stage, master, initial):
         opti = master.opti if hasattr(master, 'opti') else master
         opti.cache_advanced()
@@ -154,6 +180,13 @@ class DirectMethod:
                 opti.set_value(self.P[i], value)
         assert found, "You attempted to set the value of a non-parameter."
 
+    def parameter_symbols(self, stage, parameter):
+        """Opti parameters that hold the value of a stage parameter, one per grid point"""
+        for i, p in enumerate(stage.parameters['']):
+            if is_equal(parameter, p):
+                return [self.P[i]]
+        raise Exception("You attempted to set the value of a non-parameter. Got " + str(parameter))
+
     def transcribe_placeholders(self, phase, stage, placeholders):
         pass
 
@@ -175,9 +208,16 @@ class DirectMethod:
     def debug(self):
         self.opti.debug
 
-    def solver(self, solver, solver_options={}):
+    @property
+    def stagewise(self):
+        """Is the NLP handed to a solver that exploits its stage-wise structure?"""
+        return self._solver in self.stagewise_solvers
+
+    def solver(self, solver, solver_options={}, cache=False, cache_dir=None):
         self._solver = solver
         self._solver_options = solver_options
+        self._solver_cache = cache
+        self._solver_cache_dir = cache_dir
 
     def show_infeasibilities(self, *args):
         self.opti.debug.show_infeasibilities(*args)
@@ -242,6 +282,91 @@ class DirectMethod:
 
 from casadi import substitute
 
+class SolverCache:
+    """Least-recently-used cache of NLP solvers, keyed on the structure of the transcribed problem
+
+    Problems that transcribe to the same NLP, up to values of parameters and initial guesses,
+    share a solver instance, including its derivative functions and any JIT-compiled code.
+    """
+    def __init__(self, capacity=16):
+        self.capacity = capacity
+        self._solvers = OrderedDict()
+
+    def key(self, opti, *solver_args):
+        """Structural hash of an Opti problem and its solver settings
+
+        The problem must be fully built: the hash covers a serialized Function of the NLP.
+        """
+        advanced = opti.advanced
+        x = symvar(advanced.x)
+        p = symvar(advanced.p)
+        # Decision variables and parameters are renamed such that the hash is independent of the Opti instance
+        x_canon = [MX.sym("x", e.sparsity()) for e in x]
+        p_canon = [MX.sym("p", e.sparsity()) for e in p]
+        nlp = substitute([advanced.f, advanced.g, advanced.lbg, advanced.ubg], x+p, x_canon+p_canon)
+        f = Function("nlp", [veccat(*x_canon), veccat(*p_canon)], nlp)
+        h = hashlib.sha256(f.serialize().encode())
+        h.update(repr(solver_args).encode())
+        h.update(casadi.__version__.encode())
+        return h.hexdigest()
+
+    def get(self, key, directory=None):
+        """Retrieve a solver
+
+        Parameters
+        ----------
+        key : str
+            Structural hash
+        directory : str, optional
+            Directory to look for a serialized solver when it is not held in memory
+
+        Returns
+        -------
+        solver : :obj:`casadi.Function` or None
+        """
+        if key in self._solvers:
+            self._solvers.move_to_end(key)
+            return self._solvers[key]
+        if directory is not None:
+            filename = os.path.join(directory, key + ".casadi")
+            if os.path.exists(filename):
+                solver = Function.load(filename)
+                self.put(key, solver)
+                return solver
+        return None
+
+    def put(self, key, solver, directory=None):
+        """Store a solver
+
+        Parameters
+        ----------
+        key : str
+            Structural hash
+        solver : :obj:`casadi.Function`
+        directory : str, optional
+            Directory to serialize the solver to
+        """
+        self._solvers[key] = solver
+        self._solvers.move_to_end(key)
+        while len(self._solvers)>self.capacity:
+            self._solvers.popitem(last=False)
+        if directory is not None:
+            filename = os.path.join(directory, key + ".casadi")
+            if not os.path.exists(filename):
+                os.makedirs(directory, exist_ok=True)
+                # Other processes may be reading the cache: never expose a partially written file
+                temp = "%s.%d.tmp" % (filename, os.getpid())
+                solver.save(temp)
+                os.replace(temp, filename)
+
+    def clear(self):
+        self._solvers.clear()
+
+    def __len__(self):
+        return len(self._solvers)
+
+solver_cache = SolverCache()
+
 class OptiWrapper(Opti):
     def __init__(self, ocp):
         self.ocp = ocp
@@ -250,9 +375,22 @@ class OptiWrapper(Opti):
         self.initial_values = []
         self.constraints = []
         self.objective = 0
+        self.solver_cache = None
+        self.solver_cache_dir = None
+        self.sample_cache = OrderedDict()
+        self.sample_seen = OrderedDict()
+        self.kkt_function = None
+        self.discrete_system_cache = {}
+        self._solver_args = ()
+        self._solver_key = None
+        self._cached_solver = None
+        self._cached_args = None
+        self._cached_sol = None
 
     def subject_to(self, expr=None, scale=1, meta=None):
-        meta = merge_meta(meta, get_meta())
+        # The meta data of a stage constraint identifies the origin of the constraints it gives rise to
+        origin = meta
+        meta = merge_meta(meta, get_meta(debug=self.ocp._debug_meta))
         if expr is None:
             self.constraints = []
         else:
@@ -261,7 +399,23 @@ class OptiWrapper(Opti):
                     return
                 else:
                     raise Exception("You have a constraint that is never statisfied.")
-            self.constraints.append((expr, scale, meta))
+            self.constraints.append((expr, scale, meta, origin))
+
+    def retract(self, origins):
+        """Remove constraints that originate from stage constraints other than origins
+
+        Parameters
+        ----------
+        origins : iterable of dict
+            Meta data of the stage constraints that should remain
+        """
+        keep = set(id(m) for m in origins)
+        self.constraints = [c for c in self.constraints if c[3] is None or id(c[3]) in keep]
+
+    @property
+    def origins(self):
+        """Meta data of all stage constraints that gave rise to constraints"""
+        return [c[3] for c in self.constraints if c[3] is not None]
 
     def add_objective(self, expr):
         self.objective = self.objective + expr
@@ -277,19 +431,27 @@ class OptiWrapper(Opti):
 
     @property
     def non_converged_solution(self):
-        return OptiSolWrapper(self, self.debug)
+        return OptiSolWrapper(self, self.debug if self._cached_sol is None else self._cached_sol)
+
+    def solver(self, solver, *args):
+        self._solver_args = (solver,) + args
+        Opti.solver(self, solver, *args)
 
     def variable(self,n=1,m=1, scale=1):
         if n==0 or m==0:
             return MX(n, m)
-        else:
+        elif debug_meta(self.ocp._debug_meta) or not hasattr(Opti, "_variable"):
             return scale*Opti.variable(self,n, m)
+        else:
+            # Skip the stack trace that Opti.variable attaches
+            return scale*self._variable(n, m)
 
     def cache_advanced(self):
         self._advanced_cache = self.advanced
+        self._advanced_symvar_cache = set([hash(e) for e in self._advanced_cache.symvar()])
 
     def set_initial(self, key, value, cache_advanced=False):
-        a = set([hash(e) for e in (self._advanced_cache if cache_advanced else self.advanced).symvar()])
+        a = self._advanced_symvar_cache if cache_advanced else set([hash(e) for e in self.advanced.symvar()])
         b = set([hash(e) for e in symvar(key)])
         if len(a | b)==len(a):
             Opti.set_initial(self, key, value) # set_initial logic in direct_collocation needs this
@@ -298,6 +460,9 @@ class OptiWrapper(Opti):
             self.initial_values.append(value)
 
     def transcribe_placeholders(self,phase,placeholders):
+        self._solver_key = None
+        self._cached_solver = None
+        self._cached_args = None
         opti_advanced = self.advanced
         Opti.subject_to(self)
         n_constr = len(self.constraints)
@@ -332,18 +497,156 @@ class OptiWrapper(Opti):
                         lb = mc.lb/scale
                         canon = mc.canon/scale
                         c = lb==canon
-                Opti.subject_to(self,c)
+                # Bypass the stack walk of Opti.subject_to: meta already holds the relevant trace
+                if hasattr(Opti, "_subject_to"):
+                    self._subject_to(c)
+                else:
+                    Opti.subject_to(self, c)
             except Exception as e:
                 print(meta,c)
                 raise e
-            self.update_user_dict(c, single_stacktrace(meta))
+            if meta["stacktrace"]:
+                self.update_user_dict(c, single_stacktrace(meta))
         Opti.minimize(self,res[n_constr])
         for k_orig, k, v in zip(self.initial_keys,res[n_constr+1:],self.initial_values):
             Opti.set_initial(self, k, v)
 
 
     def solve(self):
-        return OptiSolWrapper(self, Opti.solve(self))
+        self._cached_sol = None
+        if self.solver_cache is None:
+            return OptiSolWrapper(self, Opti.solve(self))
+        if self._solver_key is None:
+            self._solver_key = self.solver_cache.key(self, *self._solver_args)
+            self._cached_solver = self.solver_cache.get(self._solver_key, self.solver_cache_dir)
+            if self._cached_solver is not None:
+                advanced = self.advanced
+                self._cached_args = [advanced, [advanced.x, advanced.p, advanced.lbg, advanced.ubg, advanced.lam_g]]
+        if self._cached_solver is None:
+            try:
+                return OptiSolWrapper(self, Opti.solve(self))
+            finally:
+                solver = self.advanced.casadi_solver
+                if not solver.is_null():
+                    self.solver_cache.put(self._solver_key, solver, self.solver_cache_dir)
+        return OptiSolWrapper(self, self._solve_cached())
+
+    def _solve_cached(self):
+        """Solve with a solver instance that was constructed for an equivalent problem"""
+        advanced, args = self._cached_args
+        # Evaluate all solver inputs in one go
+        values = DM(advanced.value(vertcat(*args), Opti.initial(self)+Opti.value_parameters(self)))
+        x0, p, lbg, ubg, lam_g0 = vertsplit(values, np.cumsum([0]+[e.numel() for e in args]).tolist())
+        res = self._cached_solver(x0=x0, p=p, lbg=lbg, ubg=ubg, lam_g0=lam_g0)
+        x, p_sym, _, _, lam_g = args
+        self._cached_sol = OptiSolCached(advanced, self._cached_solver.stats(), [x, p_sym, lam_g], [res["x"], p, res["lam_g"]])
+        if not self._cached_sol.stats()["success"]:
+            raise RuntimeError("Solver failed. You may use ocp.non_converged_solution to investigate the latest values of variables. return_status is '%s'" % self._cached_sol.stats()["return_status"])
+        return self._cached_sol
+
+class OptiSolCached:
+    """Solution of an OptiWrapper obtained with a cached solver, mimics OptiSol"""
+    def __init__(self, opti, stats, symbols, values):
+        self.opti = opti
+        self._stats = stats
+        self.symbols = symbols
+        self.values = values
+        self._lookup = None
+
+    def value(self, expr, values=[]):
+        """Numerical value of expr at the solution
+
+        Parameters
+        ----------
+        expr : :obj:`casadi.MX`
+            Expression in terms of the problem symbols
+        values : list of :obj:`casadi.MX`, optional
+            Assignment expressions (e.g. x==3) that overrule the solution value of a symbol,
+            as in :meth:`casadi.OptiSol.value`
+        """
+        if self._lookup is None:
+            # Numerical value of each primitive symbol, built once
+            self._lookup = {}
+            for e, v in zip(self.symbols, self.values):
+                primitives = e.primitives()
+                for s, d in zip(primitives, vertsplit(DM(v), np.cumsum([0]+[s.numel() for s in primitives]).tolist())):
+                    self._lookup[hash(s)] = reshape(d, s.shape)
+        lookup = self._lookup
+        if values:
+            lookup = dict(lookup)
+            for v in values:
+                v = MX(v)
+                if not v.is_op(casadi.OP_EQ):
+                    raise Exception("Expected an assignment expression (e.g. x==3), got '%s'." % str(v))
+                a, b = v.dep(0), v.dep(1)
+                if a.is_symbolic():
+                    a, b = b, a
+                if not b.is_symbolic():
+                    raise Exception("Assignment expression '%s' must have a pure symbol on one side." % str(v))
+                lookup[hash(b)] = reshape(DM(evalf(a)), b.shape)
+        expr = MX(expr)
+        # Only evaluate in terms of the symbols that expr depends on
+        symbols = symvar(expr)
+        try:
+            args = [lookup[hash(s)] for s in symbols]
+        except KeyError:
+            raise Exception("Cannot evaluate an expression that depends on symbols outside of the problem.")
+        res = Function("value", symbols, [expr]).call(args)[0]
+        if res.is_scalar():
+            return float(res)
+        if res.is_vector():
+            return np.array(res).ravel()
+        return np.array(res)
+
+    def stats(self):
+        return self._stats
+
+class ParameterHandle:
+    """Setter of parameter values, see :meth:`~rockit.stage.Stage.parameter_setter`
+
+    The Opti parameters underlying the stage parameters are looked up once,
+    such that each call amounts to plain numeric writes.
+    Lookups are redone automatically when the problem got transcribed anew.
+    Values are recorded in the stage as well, such that a new transcription picks them up.
+    """
+    def __init__(self, stage, parameters):
+        self.stage = stage
+        self.parameters = parameters
+        self._opti = None
+        self._targets = None
+        self._augmented = None
+
+    def _resolve(self):
+        stage = self.stage._transcribed
+        self._targets = [stage._method.parameter_symbols(stage, p) for p in self.parameters]
+        self._opti = stage.master._method.opti
+        self._augmented = stage
+
+    def __call__(self, *values):
+        """Set values, one for each parameter
+
+        For parameters on a control grid, pass either a value for a single grid point
+        (repeated over the grid) or the values of all grid points, horizontally concatenated.
+        """
+        if len(values)!=len(self.parameters):
+            raise Exception("Expected %d values, got %d." % (len(self.parameters), len(values)))
+        if self._opti is None or not self.stage.is_transcribed or self.stage.master._method.opti is not self._opti:
+            self._resolve()
+        opti = self._opti
+        for p, targets, value in zip(self.parameters, self._targets, values):
+            value = DM(value)
+            # Same value object in original and augmented stage: not seen as a change by incremental transcription
+            self.stage._param_vals[p] = value
+            self._augmented._param_vals[p] = value
+            shape = targets[0].shape
+            if len(targets)==1 or value.is_scalar() or value.shape==shape:
+                for t in targets:
+                    Opti.set_value(opti, t, value)
+            elif value.shape==(shape[0], shape[1]*len(targets)):
+                for k, t in enumerate(targets):
+                    Opti.set_value(opti, t, value[:, k*shape[1]:(k+1)*shape[1]])
+            else:
+                raise Exception("Value of shape %s does not match a parameter of shape %s on a grid of %d points." % (str(value.shape), str(shape), len(targets)))
 
 class OptiSolWrapper:
     def __init__(self, opti_wrapper, sol):
@@ -0,0 +1,308 @@
+#
+#     This file is part of rockit.
+#
+#     rockit -- Rapid Optimal Control Kit
+#     Copyright (C) 2019 MECO, KU Leuven. All rights reserved.
+#
+#     Rockit is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU Lesser General Public
+#     License as published by the Free Software Foundation; either
+#     version 3 of the License, or (at your option) any later version.
+#
+#     Rockit is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#     Lesser General Public License for more details.
+#
+#     You should have received a copy of the GNU Lesser General Public
+#     License along with CasADi; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+#
+
+from casadi import Function, Opti, nlpsol, conic, jacobian_sparsity, jacobian, hessian, gradient, dot, mtimes, vec, vcat, vertcat, vertsplit, DM, MX
+from collections import defaultdict
+import numpy as np
+
+from .direct_method import OptiSolCached, OptiSolWrapper
+from .solution import OcpSolution
+
+
+class MPCRunner:
+    """Receding-horizon loop around a transcribed Ocp
+
+    Each call solves the NLP for a new measured state.
+    The primal and dual solution of the previous call are shifted by one control interval
+    and passed to the solver as initial guess, without any symbolic work per call.
+
+    Note that Ipopt only makes use of the dual initial guess with the option
+    'ipopt.warm_start_init_point': 'yes'.
+
+    Examples
+    --------
+
+    >>> ocp = Ocp(T=2)
+    >>> x = ocp.state()
+    >>> u = ocp.control()
+    >>> x0 = ocp.parameter()
+    >>> ocp.set_der(x, u)
+    >>> ocp.subject_to(ocp.at_t0(x)==x0)
+    >>> ocp.add_objective(ocp.integral(x**2+u**2))
+    >>> ocp.set_value(x0, 1)
+    >>> ocp.solver('ipopt')
+    >>> ocp.method(MultipleShooting())
+    >>> mpc = MPCRunner(ocp, x0)
+    >>> u0 = mpc(0.9)
+    """
+    def __init__(self, ocp, x0, u=None, shift=True):
+        """
+        Parameters
+        ----------
+        ocp : :obj:`~rockit.ocp.Ocp`
+            Optimal control problem, solved with a :obj:`~rockit.sampling_method.SamplingMethod`
+        x0 : :obj:`~casadi.MX`
+            Parameter that receives the measured state
+        u : :obj:`~casadi.MX`, optional
+            Signal of which the value at the start of the horizon is returned
+            Default: all controls
+        shift : bool, optional
+            Shift the previous solution by one control interval before using it as initial guess.
+            If False, the previous solution is used as-is.
+            Default: True
+        """
+        self.ocp = ocp
+        self.shift = shift
+        stage = ocp._transcribed
+        method = stage._method
+        self._stage = stage
+        self._opti = opti = method.opti
+
+        # Construct a dedicated solver instance and obtain all numerical data in one go
+        advanced = opti.advanced
+        advanced.bake()
+        self._construct_solver(advanced)
+        args = [advanced.x, advanced.p, advanced.lbg, advanced.ubg, advanced.lam_g]
+        values = DM(advanced.value(vertcat(*args), Opti.initial(opti)+Opti.value_parameters(opti)))
+        x, p, lbg, ubg, lam_g = [np.array(e).ravel() for e in vertsplit(values, np.cumsum([0]+[e.numel() for e in args]).tolist())]
+        self._symbols = [advanced.x, advanced.p, advanced.lam_g]
+
+        self._x = x
+        self._p = p
+        self._lam_g = lam_g
+        self._lam_x = np.zeros(self._x.shape)
+        self._bounds = Function("bounds", [advanced.p], [advanced.lbg, advanced.ubg])
+        self._x0_index = self._positions(vcat([vec(e) for e in method.parameter_symbols(stage, x0)]), advanced.p)
+
+        if u is None:
+            u = stage.u
+        u_first = ocp.sample(u, grid='control')[1][:, 0] if u.shape[0]>1 else ocp.sample(u, grid='control')[1][0]
+        self._first = Function("first", [advanced.x, advanced.p], [vec(u_first)])
+        self.u = np.zeros(self._first.numel_out(0))
+
+        self._x_src = np.arange(self._x.size)
+        self._g_src = np.arange(self._lam_g.size)
+        if shift:
+            self._shift_maps(method, advanced, lbg==ubg)
+        self._stats = None
+
+    def _construct_solver(self, advanced):
+        if not self._opti._solver_args:
+            raise Exception("You forgot to declare a solver. Use e.g. ocp.solver('ipopt').")
+        self._solver = nlpsol("solver", *self._opti._solver_args[:1], {"x": advanced.x, "p": advanced.p, "f": advanced.f, "g": advanced.g}, *self._opti._solver_args[1:])
+
+    @staticmethod
+    def _positions(e, v):
+        """Position in v of each entry of e, -1 if not a single entry of v"""
+        sp = jacobian_sparsity(e, v)
+        row = np.array(sp.get_triplet()[0])
+        col = np.array(sp.get_triplet()[1])
+        ret = -np.ones(e.numel(), dtype=int)
+        count = np.bincount(row, minlength=e.numel())
+        ret[row] = col
+        ret[count!=1] = -1
+        return ret
+
+    def _shift_maps(self, method, advanced, equality):
+        # Primal: entry k of a sequence of decision variables gets the value of entry k+stride
+        sequences = [(seq, stride) for seq, stride in method.interval_variables() if len(seq)>stride]
+        entries = [vec(e) for seq, _ in sequences for e in seq]
+        if entries:
+            positions = self._positions(vcat(entries), advanced.x)
+            offset = 0
+            for seq, stride in sequences:
+                pos = []
+                for e in seq:
+                    pos.append(positions[offset:offset+e.numel()])
+                    offset += e.numel()
+                for a, b in zip(pos[:-stride], pos[stride:]):
+                    if a.size!=b.size or np.any(a<0) or np.any(b<0): continue
+                    self._x_src[a] = b
+
+        # Dual: a constraint gets the multiplier of the constraint of the same kind
+        # that depends on the shifted variables
+        sp = jacobian_sparsity(advanced.g, advanced.x)
+        rows = [[] for i in range(sp.size1())]
+        for r, c in zip(*sp.get_triplet()):
+            rows[r].append(c)
+        groups = defaultdict(list)
+        signatures = []
+        for i, cols in enumerate(rows):
+            signature = (tuple(sorted(set(cols))), equality[i])
+            signatures.append((tuple(sorted(set(self._x_src[cols]))), equality[i], len(groups[signature])))
+            groups[signature].append(i)
+        for i, (shifted, eq, rank) in enumerate(signatures):
+            target = groups.get((shifted, eq), [])
+            if rank<len(target):
+                self._g_src[i] = target[rank]
+
+    def __call__(self, x_meas):
+        """Solve for a measured state
+
+        Parameters
+        ----------
+        x_meas : array-like
+            Value for the state parameter
+
+        Returns
+        -------
+        u : :obj:`numpy.ndarray`
+            Value of the signal at the start of the horizon.
+            The same buffer is overwritten by subsequent calls.
+        """
+        self._p[self._x0_index] = np.array(x_meas, dtype=float).ravel()
+        lbg, ubg = self._bounds(self._p)
+        res = self._solver(x0=self._x, p=self._p, lbg=lbg, ubg=ubg, lam_g0=self._lam_g, lam_x0=self._lam_x)
+        self._stats = self._solver.stats()
+        self._res = res
+        x = np.array(res["x"]).ravel()
+        lam_g = np.array(res["lam_g"]).ravel()
+        lam_x = np.array(res["lam_x"]).ravel()
+        self.u[:] = np.array(self._first(x, self._p)).ravel()
+
+        self._x = x[self._x_src]
+        self._lam_g = lam_g[self._g_src]
+        self._lam_x = lam_x[self._x_src]
+        if not self._stats["success"]:
+            raise Exception("Solver failed. return_status is '%s'" % self._stats["return_status"])
+        return self.u
+
+    @property
+    def solution(self):
+        """Solution of the latest call, as :obj:`~rockit.solution.OcpSolution`"""
+        if self._stats is None:
+            raise Exception("You forgot to solve first.")
+        sol = OptiSolCached(self._opti.advanced, self._stats, self._symbols, [self._res["x"], DM(self._p), self._res["lam_g"]])
+        return OcpSolution(OptiSolWrapper(self._opti, sol), self._stage)
+
+    @property
+    def stats(self):
+        return self._stats
+
+
+class RTIRunner(MPCRunner):
+    """Real-time iteration scheme around a transcribed Ocp
+
+    Instead of solving the NLP to convergence, each sampling instant takes a single
+    SQP step with exact Hessian. The work is split in two phases:
+
+    * :meth:`prepare` shifts the previous iterate and linearizes the NLP around it.
+      This does not depend on the measurement and can run ahead of time.
+    * :meth:`feedback` solves the resulting QP once the measurement is known.
+
+    Calling the object performs feedback followed by preparation for the next instant.
+
+    Examples
+    --------
+
+    >>> mpc = RTIRunner(ocp, x0)
+    >>> u0 = mpc.feedback(0.9)  # latency-critical
+    >>> mpc.prepare()           # while waiting for the next measurement
+    """
+    def __init__(self, ocp, x0, u=None, shift=True, qpsol='qrqp', qpsol_options=None):
+        """
+        Parameters
+        ----------
+        ocp : :obj:`~rockit.ocp.Ocp`
+            Optimal control problem, solved with a :obj:`~rockit.sampling_method.SamplingMethod`
+        x0 : :obj:`~casadi.MX`
+            Parameter that receives the measured state
+        u : :obj:`~casadi.MX`, optional
+            Signal of which the value at the start of the horizon is returned
+            Default: all controls
+        shift : bool, optional
+            Shift the iterate by one control interval in the preparation phase.
+            Default: True
+        qpsol : str, optional
+            Name of the CasADi conic solver plugin
+            Default: 'qrqp'
+        qpsol_options : dict, optional
+            Options passed to the QP solver
+            Default: silent output for 'qrqp'
+        """
+        if qpsol_options is None:
+            qpsol_options = {"print_iter": False, "print_header": False, "print_info": False} if qpsol=="qrqp" else {}
+        self._qpsol = qpsol
+        self._qpsol_options = qpsol_options
+        MPCRunner.__init__(self, ocp, x0, u=u, shift=shift)
+        self._prepared_p = None
+        self.prepare(shift=False)
+
+    def _construct_solver(self, advanced):
+        x, p, f, g = advanced.x, advanced.p, advanced.f, advanced.g
+        lam_g = MX.sym("lam_g", g.sparsity())
+        lag = f+dot(lam_g, g)
+        H = hessian(lag, x)[0]
+        grad = gradient(f, x)
+        self._linearization = Function("linearization", [x, p, lam_g],
+            [H, grad, jacobian(gradient(lag, x), p), g, jacobian(g, x), jacobian(g, p)])
+        self._solver = conic("solver", self._qpsol, {"h": H.sparsity(), "a": jacobian_sparsity(g, x)}, self._qpsol_options)
+
+    def prepare(self, shift=None):
+        """Linearize around the (shifted) current iterate
+
+        Parameters
+        ----------
+        shift : bool, optional
+            Default: as passed to the constructor
+        """
+        if shift is None:
+            shift = self.shift
+        if shift:
+            self._x = self._x[self._x_src]
+            self._lam_g = self._lam_g[self._g_src]
+        self._prepared_p = np.array(self._p)
+        self._H, self._grad, self._grad_p, self._g, self._A, self._A_p = self._linearization(self._x, self._p, self._lam_g)
+
+    def feedback(self, x_meas):
+        """Solve the prepared QP for a measured state
+
+        Parameters
+        ----------
+        x_meas : array-like
+            Value for the state parameter
+
+        Returns
+        -------
+        u : :obj:`numpy.ndarray`
+            Value of the signal at the start of the horizon.
+            The same buffer is overwritten by subsequent calls.
+        """
+        self._p[self._x0_index] = np.array(x_meas, dtype=float).ravel()
+        dp = DM(self._p-self._prepared_p)
+        lbg, ubg = self._bounds(self._p)
+        g = self._g+mtimes(self._A_p, dp)
+        res = self._solver(h=self._H, g=self._grad+mtimes(self._grad_p, dp), a=self._A, lba=lbg-g, uba=ubg-g)
+        self._stats = self._solver.stats()
+        self._x = self._x+np.array(res["x"]).ravel()
+        self._lam_g = np.array(res["lam_a"]).ravel()
+        self._res = {"x": DM(self._x), "lam_g": DM(self._lam_g)}
+        self.u[:] = np.array(self._first(self._x, self._p)).ravel()
+        if not self._stats["success"]:
+            raise Exception("QP solver failed. return_status is '%s'" % self._stats["return_status"])
+        return self.u
+
+    def __call__(self, x_meas):
+        """Feedback for a measured state, followed by preparation of the next instant"""
+        u = self.feedback(x_meas)
+        self.prepare()
+        return u
@@ -21,14 +21,52 @@
 #
 
 from .sampling_method import SamplingMethod
-from casadi import sumsqr, vertcat, linspace, substitute, MX, evalf, vcat, horzsplit, veccat, DM, repmat, vvcat, vec
+from casadi import sumsqr, vertcat, linspace, substitute, MX, evalf, vcat, horzsplit, veccat, DM, repmat, vvcat, vec, hcat, depends_on
 import numpy as np
 
 from .casadi_helpers import vcat
 
 class MultipleShooting(SamplingMethod):
-    def __init__(self, **kwargs):
+    def __init__(self, vectorize=False, parallelization='serial', max_num_threads=None, condense_block=1, **kwargs):
+        """
+        Parameters
+        ----------
+        vectorize : bool, optional
+            Evaluate the discretised system for all control intervals in a single
+            mapped call, and impose the gap-closing constraints as one matrix-valued constraint.
+            Leads to the same NLP, with a much smaller expression graph for long horizons.
+            With a stage-wise solver (e.g. 'fatrop'), the gap-closing constraints
+            stay interleaved with the path constraints of each interval.
+            Default: False
+        parallelization : str, optional
+            Evaluation strategy of the mapped discretised system: 'serial', 'thread' or 'openmp'.
+            Anything other than 'serial' implies vectorize=True.
+            Useful for expensive integrators (e.g. intg='cvodes').
+            Specific to MultipleShooting: other sampling methods do not accept this option.
+            Default: 'serial'
+        max_num_threads : int, optional
+            Maximum number of workers used for parallelization,
+            likewise specific to MultipleShooting
+            Default: None (as many as there are control intervals)
+        condense_block : int, optional
+            Partial condensing: only every condense_block-th state (and the final state)
+            is a decision variable. The states in between are eliminated by chaining
+            the discretised system, as in SingleShooting.
+            Trades NLP size for Jacobian density; condense_block=N resembles SingleShooting.
+            Not supported in combination with vectorize.
+            Default: 1 (no condensing)
+        """
         SamplingMethod.__init__(self, **kwargs)
+        if parallelization not in ['serial', 'thread', 'openmp']:
+            raise Exception("Unknown parallelization '%s'. Options are 'serial', 'thread' or 'openmp'." % parallelization)
+        self.vectorize = vectorize or parallelization!='serial'
+        self.parallelization = parallelization
+        self.max_num_threads = max_num_threads
+        if condense_block<1:
+            raise Exception("condense_block must be a positive integer, got %s." % str(condense_block))
+        if condense_block>1 and self.vectorize:
+            raise Exception("condense_block is not supported in combination with vectorize or parallelization.")
+        self.condense_block = condense_block
 
     def add_variables(self, stage, opti):
         # We are creating variables in a special order such that the resulting constraint Jacobian
@@ -39,8 +77,11 @@ class MultipleShooting(SamplingMethod):
         for k in range(self.N):
             self.U.append(vcat([opti.variable(s.numel(), scale=vec(stage._scale[s])) for s in stage.controls]) if stage.nu>0 else MX(0,1))
             self.add_variables_V_control(stage, opti, k)
-            self.X.append(vcat([opti.variable(s.numel(), scale=vec(stage._scale[s])) for s in stage.states]))
-            
+            if self.shooting_node(k+1):
+                self.X.append(vcat([opti.variable(s.numel(), scale=vec(stage._scale[s])) for s in stage.states]))
+            else:
+                # Eliminated state, filled in by add_constraints
+                self.X.append(None)
 
         self.add_variables_V_control_finalize(stage, opti)
 
@@ -55,12 +96,19 @@ class MultipleShooting(SamplingMethod):
 
         self.q = 0
 
-        FFs = []
+        if self.vectorize:
+            FF_all, FFs = self.map_discrete_system(stage, F)
+        else:
+            FFs = []
+            for k in range(self.N):
+                FFs.append(F(x0=self.X[k], u=self.U[k], t0=self.control_grid[k],
+                             T=self.control_grid[k + 1] - self.control_grid[k], p=self.get_p_sys(stage, k)))
+                if not self.shooting_node(k+1):
+                    self.X[k + 1] = FFs[k]["xf"]
+
         # Fill in Z variables up-front, since they might be needed in constraints with ocp.next
         for k in range(self.N):
-            FF = F(x0=self.X[k], u=self.U[k], t0=self.control_grid[k],
-                   T=self.control_grid[k + 1] - self.control_grid[k], p=self.get_p_sys(stage, k))
-            FFs.append(FF)
+            FF = FFs[k]
             # Save intermediate info
             poly_coeff_temp = FF["poly_coeff"]
             poly_coeff_z_temp = FF["poly_coeff_z"]
@@ -73,42 +121,74 @@ class MultipleShooting(SamplingMethod):
             if k==0:
                 self.Z.append(zk_temp[:, 0])
             self.Z.append(FF["zf"])
+            if self.poly_coeff is not None and not self.vectorize:
+                self.poly_coeff.extend_blocks(poly_coeff_temp, self.M)
+            if self.poly_coeff_z is not None and not self.vectorize:
+                self.poly_coeff_z.extend_blocks(poly_coeff_z_temp, self.M)
+
+        if self.vectorize:
+            # Keep the coefficients of all intervals in the single block returned by the mapped call
             if self.poly_coeff is not None:
-                self.poly_coeff.extend(horzsplit(poly_coeff_temp, poly_coeff_temp.shape[1]//self.M))
+                self.poly_coeff.extend_blocks(FF_all["poly_coeff"], self.N*self.M)
             if self.poly_coeff_z is not None:
-                self.poly_coeff_z.extend(horzsplit(poly_coeff_z_temp, poly_coeff_z_temp.shape[1]//self.M))
+                self.poly_coeff_z.extend_blocks(FF_all["poly_coeff_z"], self.N*self.M)
 
         self.xk.append(self.X[-1])
         self.zk.append(self.zk[-1])
         scale_x = stage._scale_x
 
+        # Stage-wise solvers need the gap-closing constraints interleaved with the path constraints
+        gaps_at_once = self.vectorize and not stage.master._method.stagewise
+        if gaps_at_once:
+            # Dynamic constraints a.k.a. gap-closing constraints, for all intervals at once
+            opti.subject_to(hcat(self.X[1:]) == FF_all["xf"], scale=repmat(scale_x, 1, self.N))
+
         for k in range(self.N):
             FF = FFs[k]
             # Dynamic constraints a.k.a. gap-closing constraints
-            opti.subject_to(self.X[k + 1] == FF["xf"], scale=scale_x)
+            if not gaps_at_once and self.shooting_node(k+1):
+                opti.subject_to(self.X[k + 1] == FF["xf"], scale=scale_x)
             self.q = self.q + FF["qf"]
 
-            for l in range(self.M):
-                for c, meta, args in stage._constraints["integrator"]:
-                    if k==0 and l==0 and not args["include_first"]: continue
-                    opti.subject_to(self.eval_at_integrator(stage, c, k, l), scale=args["scale"], meta=meta)
-                for c, meta, _ in stage._constraints["inf"]:
-                    self.add_inf_constraints(stage, opti, c, k, l, meta)
-
-            for c, meta, args in stage._constraints["control"]:  # for each constraint expression
-                if k==0 and not args["include_first"]: continue
-                try:
-                    opti.subject_to(self.eval_at_control(stage, c, k), scale=args["scale"], meta=meta)
-                except IndexError:
-                    pass # Can be caused by ocp.offset -> drop constraint
-
+            self.add_constraints_interval(stage, opti, k, stage._constraints)
             self.add_coupling_constraints(stage, opti, k)
 
-        for c, meta, args in stage._constraints["control"]+stage._constraints["integrator"]:  # for each constraint expression
-            if not args["include_last"]: continue
-            # Add it to the optimizer, but first make x,u concrete.
-            try:
-                opti.subject_to(self.eval_at_control(stage, c, -1), scale=args["scale"], meta=meta)
-            except IndexError:
-                pass 
-            
+        self.add_constraints_last(stage, opti, stage._constraints)
+
+    def shooting_node(self, k):
+        """Is the state at control point k a decision variable?"""
+        return k<0 or k>=self.N or k % self.condense_block==0
+
+    def initial_points(self, stage, var):
+        ks = SamplingMethod.initial_points(self, stage, var)
+        if self.condense_block>1 and depends_on(var, stage.x):
+            # Eliminated states cannot receive an initial guess
+            ks = [k for k in ks if self.shooting_node(k)]
+        return ks
+
+    def interval_variables(self):
+        return SamplingMethod.interval_variables(self) + [(self.X, 1)]
+
+    def map_discrete_system(self, stage, F):
+        """Evaluate the discretised system F on all control intervals with a single (parallel) call
+
+        Returns
+        -------
+        res : dict
+            Outputs of F, horizontally stacked over the control intervals
+        FFs : list of dict
+            Outputs of F, split per control interval
+        """
+        if self.max_num_threads is None:
+            F_map = F.map(self.N, self.parallelization)
+        else:
+            F_map = F.map(self.N, self.parallelization, self.max_num_threads)
+        control_grid = vec(self.control_grid).T
+        res = F_map(x0=hcat(self.X[:-1]), u=hcat(self.U), t0=control_grid[:, :-1],
+                    T=control_grid[:, 1:] - control_grid[:, :-1], p=hcat([self.get_p_sys(stage, k) for k in range(self.N)]))
+        FFs = [{} for k in range(self.N)]
+        for name, value in res.items():
+            n = F.size2_out(name)
+            for FF, e in zip(FFs, horzsplit(value, n) if n>0 else [value]*self.N):
+                FF[name] = e
+        return res, FFs
@@ -22,11 +22,13 @@
 from casadi import vertcat, vcat, which_depends, MX, substitute, integrator, Function, depends_on
 from .stage import Stage, transcribed
 from .placeholders import TranscribedPlaceholders
-from .casadi_helpers import vvcat, rockit_pickle_context, rockit_unpickle_context
+from .casadi_helpers import vvcat, rockit_pickle_context, rockit_unpickle_context, HashOrderedDict
 from .external.manager import external_method
 from .direct_method import DirectMethod
+from collections import defaultdict
+from copy import copy, deepcopy
 class Ocp(Stage):
-    def __init__(self,  t0=0, T=1, **kwargs):
+    def __init__(self,  t0=0, T=1, debug_meta=None, **kwargs):
         """Create an Optimal Control Problem environment
 
         Parameters
@@ -37,17 +39,25 @@ class Ocp(Stage):
         T : float or :obj:`~rockit.freetime.FreeTime`, optional
             Total horizon of the optimal control horizon
             Default: 1
+        debug_meta : bool, optional
+            Record stack traces of variables and constraints,
+            to map error messages and infeasibilities back to source lines.
+            Disable to save time and memory for large problems.
+            Default: None, which defers to :func:`~rockit.casadi_helpers.set_debug_meta`
 
         Examples
         --------
 
         >>> ocp = Ocp()
         """
+        self._var_debug_meta = debug_meta
         Stage.__init__(self,  t0=t0, T=T, **kwargs)
         self._master = self
         # Flag to make solve() faster when solving a second time
         # (e.g. with different parameter values)
         self._var_is_transcribed = False
+        # Components that were modified since the last transcription
+        self._var_dirty = set()
         self._transcribed_placeholders = TranscribedPlaceholders()
 
     @transcribed
@@ -80,15 +90,25 @@ class Ocp(Stage):
         if self._is_original:
             if self._is_transcribed:
                 return self._augmented
+            elif self._transcribe_incremental():
+                return self._augmented
             else:
+                if self._var_augmented is not None:
+                    # Methods are shared with the earlier transcription
+                    self._var_augmented._untranscribe_recurse(phase=1)
 
-                import copy
-                augmented = copy.deepcopy(self)
+                augmented = deepcopy(self)
                 augmented._master = augmented
                 augmented._transcribed_placeholders = self._transcribed_placeholders
                 augmented._var_original = self
                 self._var_augmented = augmented
                 augmented._placeholders = self._placeholders
+                # Copy stage constraints, parameter values and initial guesses of the original,
+                # such that later changes to the original can be tracked for incremental transcription
+                for s, a in zip(self.iter_stages(include_self=True), augmented.iter_stages(include_self=True)):
+                    a._constraints = defaultdict(list, {k: list(v) for k, v in s._constraints.items()})
+                    a._param_vals = copy(s._param_vals)
+                    a._initial = copy(s._initial)
                 
                 return self._augmented._transcribed
         else:
@@ -100,10 +120,85 @@ class Ocp(Stage):
             self._transcribed_placeholders.clear()
             self._transcribe_recurse(phase=0)
             self._placeholders_transcribe_recurse(1,self._transcribed_placeholders)
+            # Remember the constraints that were added while transcribing placeholders
+            for s, a in zip(self._original.iter_stages(include_self=True), self.iter_stages(include_self=True)):
+                a._constraints_placeholders = {k: v[len(s._constraints[k]):] for k, v in a._constraints.items()}
             self._transcribe_recurse(phase=1)
             self._original._set_transcribed(True)
 
             self._transcribe_recurse(phase=2,placeholders=self.placeholders_transcribed)
+
+    def _transcribe_incremental(self):
+        """Bring an earlier transcription up to date with modified constraints or objective
+
+        Variables and dynamics of the earlier transcription are kept.
+        Only constraints stemming from removed or added stage constraints are
+        retracted from or emitted into the existing Opti instance.
+
+        Returns
+        -------
+        success : bool
+            False when a full transcription is needed
+        """
+        augmented = self._var_augmented
+        if augmented is None or not self._var_dirty <= {'constraints', 'objective'}:
+            return False
+        pairs = list(zip(self.iter_stages(include_self=True), augmented.iter_stages(include_self=True)))
+        if not all(getattr(a._method, 'incremental', False) for _, a in pairs):
+            return False
+
+        def signature():
+            return [(len(a.states), len(a.qstates), len(a.controls), len(a.algebraics),
+                     sum(len(v) for v in a.variables.values()), sum(len(v) for v in a.parameters.values()),
+                     sum(len(v) for v in a._constraints.values())) for _, a in pairs]
+
+        for s, a in pairs:
+            for k, v in s._placeholders.items():
+                if k not in a._placeholders:
+                    a._placeholders[k] = v
+            a._offsets = copy(s._offsets)
+            a._inf_der = copy(s._inf_der)
+            a._inf_inert = copy(s._inf_inert)
+            a._constraints = defaultdict(list)
+            for k in set(s._constraints.keys()) | set(a._constraints_placeholders.keys()):
+                a._constraints[k] = s._constraints[k] + a._constraints_placeholders.get(k, [])
+            a._objective = s._objective
+
+        # New placeholders may not alter the structure of the problem (e.g. ocp.integral)
+        before = signature()
+        self._transcribed_placeholders.mark_dirty()
+        augmented._placeholders_transcribe_recurse(1, self._transcribed_placeholders)
+        if signature()!=before:
+            return False
+
+        opti = augmented._method.opti
+        emitted = set(id(m) for m in opti.origins)
+        opti.retract([m for _, a in pairs for v in a._constraints.values() for _, m, _ in v])
+        for _, a in pairs:
+            a._method.add_stage_constraints(a, opti, {k: [c for c in v if id(c[1]) not in emitted] for k, v in a._constraints.items()})
+
+        if 'objective' in self._var_dirty:
+            opti.clear_objective()
+            for _, a in pairs:
+                a._method.add_objective(a, opti)
+
+        # Parameter values and initial guesses declared in the mean time
+        for s, a in pairs:
+            for p, v in s._param_vals.items():
+                if p not in a._param_vals or a._param_vals[p] is not v:
+                    a._param_vals[p] = v
+                    a._method.set_value(a, augmented._method, p, v)
+            initial = HashOrderedDict()
+            for var, v in s._initial.items():
+                if var not in a._initial or a._initial[var] is not v:
+                    a._initial[var] = v
+                    initial[var] = v
+            if initial:
+                a._method.set_initial(a, augmented._method, initial)
+
+        self._set_transcribed(True)
+        augmented._transcribe_recurse(phase=2, placeholders=augmented.placeholders_transcribed)
+        return True
     
     def _untranscribe(self):
         if self.is_transcribed:
@@ -138,6 +233,46 @@ class Ocp(Stage):
     def solve_limited(self):
         return self._method.solve_limited(self)
 
+    def solve_batch(self, param_table, initial_table=None, workers=1, results=None):
+        """Solve the problem for many parameter values and initial guesses
+
+        Parameters
+        ----------
+        param_table : dict
+            For each parameter that varies, an array of values with one entry per instance
+        initial_table : dict, optional
+            For expressions that select decision variables (e.g. ocp.sample(x, grid='control')[1]),
+            an array of initial guesses with one entry per instance
+        workers : int, optional
+            Number of worker processes. Instances are solved in-process if 1.
+            Default: 1
+        results : dict, optional
+            Expressions to evaluate at each solution, keyed by name
+            Default: {"gist": ocp.gist}, to be used with :meth:`~rockit.stage.Stage.sampler`
+
+        Returns
+        -------
+        results : dict of numpy.ndarray
+            Values of the results, stacked over the instances along the first axis.
+            nan for instances that raised an error.
+        stats : list of dict
+            Solver statistics of each instance.
+            Failed instances do not affect the others; check stats[i]["success"].
+
+        Examples
+        --------
+
+        >>> res, stats = ocp.solve_batch({b: np.linspace(0, 1, 100)}, workers=4,
+        ...                              results={"u": ocp.sample(u, grid='control')[1]})
+        """
+        from .batch import BatchSolver
+        if initial_table is None:
+            initial_table = {}
+        if results is None:
+            results = {"gist": self.gist}
+        batch = BatchSolver(self, list(param_table.keys()), list(initial_table.keys()), results)
+        return batch(list(param_table.values()), list(initial_table.values()), workers=workers)
+
     def callback(self, fun):
         self._set_transcribed(False)
         return self._method.callback(self, fun)
@@ -146,8 +281,38 @@ class Ocp(Stage):
     def debug(self):
         self._method.debug
 
-    def solver(self, solver, solver_options={}):
-        self._method.solver(solver, solver_options)
+    def solver(self, solver, solver_options={}, cache=False, cache_dir=None):
+        """Choose a numerical solver
+
+        Parameters
+        ----------
+        solver : str
+            Name of the NLP solver plugin, e.g. 'ipopt'.
+            'fatrop' exploits the stage-wise structure of a MultipleShooting transcription,
+            with per-iteration cost linear in the number of control intervals.
+            Problem-wide decision variables (ocp.variable) break this structure.
+        solver_options : dict, optional
+            Options passed to the solver.
+            For 'fatrop', structure_detection defaults to 'auto'.
+        cache : bool, optional
+            Reuse the solver instance constructed for an earlier problem
+            that transcribed to the same NLP (up to values of parameters and initial guesses),
+            across Ocp instances.
+            The number of solvers kept is bounded by rockit.direct_method.solver_cache.capacity.
+            Not used in combination with callbacks.
+            Default: False
+        cache_dir : str, optional
+            Directory in which solvers are serialized, keyed on the same structural hash.
+            Processes sharing this directory load the solver instead of constructing it.
+            JIT-compiled code is embedded (jit_serialize='embed'), unless specified otherwise.
+            Implies cache=True.
+            The structural hash is computed from the transcribed NLP:
+            a cache hit saves constructing the solver (derivative functions, JIT compilation),
+            but the problem is still transcribed and serialized once to obtain its hash.
+            Default: None
+        """
+        self._set_transcribed(False)
+        self._method.solver(solver, solver_options, cache, cache_dir)
 
     def show_infeasibilities(self, *args):
         self._method.show_infeasibilities(*args)
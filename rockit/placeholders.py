@@ -1,4 +1,4 @@
-from casadi import substitute, depends_on, vvcat, DM
+from casadi import substitute, depends_on, vvcat, symvar, DM, MX
 from .casadi_helpers import HashDict
 from collections import defaultdict
 
@@ -8,20 +8,23 @@ class TranscribedPlaceholders:
 
     def clear(self):
         self.pool = [HashDict() for i in range(2)]
+        self._memo = {}
         self.mark_dirty()
 
     def mark_dirty(self):
         self.is_dirty = True
+        self._resolved = {}
 
     def __getitem__(self, i):
         return self.pool[i-1]
 
-    def _replace(self,args,ks,vs):
+    def _replace(self,args,ks,vs,kv=None):
         # No use doing placeholder substitution on DM
         if isinstance(vvcat(args), DM):
             return args
 
-        kv = vvcat(ks)
+        if kv is None:
+            kv = vvcat(ks)
 
         # Fixed-point iteration
         while depends_on(vvcat(args), kv):
@@ -29,15 +32,61 @@ class TranscribedPlaceholders:
 
         return args
 
-    def __call__(self, args, max_phase=2, preference=None, verbose=False):
-        if not isinstance(args, list):
-            return self([args],max_phase=max_phase,preference=preference,verbose=verbose)[0]
+    def _resolve(self, ks, vs, memo):
+        """Substitute placeholders occurring in placeholder values
 
-        if preference is None:
-            preference = ['normal','normal.normal']
+        Values are visited in topological order of their dependencies,
+        such that each value needs a single substitution.
+        Values resolved before (memo) are reused if neither they nor their dependencies changed.
+        """
+        index = {hash(k): i for i, k in enumerate(ks)}
+        deps = []
+        for k, v in zip(ks, vs):
+            m = memo.get(hash(k))
+            if m is not None and m[1] is v and all(h in index for h in m[2]):
+                deps.append([index[h] for h in m[2]])
+                continue
+            try:
+                syms = symvar(v)
+            except:
+                syms = []
+            deps.append([index[hash(e)] for e in syms if hash(e) in index])
 
-        if not isinstance(args, list):
-            return self.__call__([args])[0]
+        resolved = [None]*len(vs)
+        changed = [None]*len(vs)
+        visiting = set()
+        def visit(i):
+            if changed[i] is not None:
+                return
+            if i in visiting:
+                raise Exception("Cyclic dependency between placeholders.")
+            visiting.add(i)
+            for j in deps[i]:
+                visit(j)
+            m = memo.get(hash(ks[i]))
+            if m is not None and m[1] is vs[i] and not any(changed[j] for j in deps[i]):
+                resolved[i] = m[3]
+                changed[i] = False
+            else:
+                if deps[i]:
+                    resolved[i] = substitute([MX(vs[i])], [ks[j] for j in deps[i]], [MX(resolved[j]) for j in deps[i]])[0]
+                else:
+                    resolved[i] = vs[i]
+                changed[i] = True
+            visiting.discard(i)
+        for i in range(len(vs)):
+            visit(i)
+        memo.clear()
+        for i, k in enumerate(ks):
+            memo[hash(k)] = (k, vs[i], [hash(ks[j]) for j in deps[i]], resolved[i])
+        return resolved
+
+    def _closure(self, max_phase, preference):
+        """Placeholder symbols and their fully resolved values
+
+        Cached until mark_dirty is called or placeholders are added or assigned other values
+        """
+        key = (max_phase, tuple(preference))
 
         def select(value):
             if len(value)==1:
@@ -54,12 +103,30 @@ class TranscribedPlaceholders:
             ks = list(self[2])
             vs = [select(self[2][e]) for e in ks]
 
-            k = [k for k in self[1].keys() if k not in self[2]]        
+            k = [k for k in self[1].keys() if k not in self[2]]
             ks += k
             vs += [select(self[1][e]) for e in k]
-            kv = vvcat(ks)
+
+        # Valid as long as each placeholder still holds the very same value
+        cached = self._resolved.get(key)
+        if cached is not None and len(cached[0])==len(vs) and all(hash(a) == hash(b) and u is v for (a, u), b, v in zip(cached[0], ks, vs)):
+            return cached[1:]
+
+        origin = list(zip(ks, vs))
+        vs = self._resolve(ks, vs, self._memo.setdefault(key, {}))
+        self._resolved[key] = (origin, ks, vs, vvcat(ks))
+        return ks, vs, vvcat(ks)
+
+    def __call__(self, args, max_phase=2, preference=None, verbose=False):
+        if not isinstance(args, list):
+            return self([args],max_phase=max_phase,preference=preference,verbose=verbose)[0]
+
+        if preference is None:
+            preference = ['normal','normal.normal']
+
+        ks, vs, kv = self._closure(max_phase, preference)
 
         if verbose:
             print(self.pool)
             print(ks,vs)
-        return self._replace(args, ks, vs)
\ No newline at end of file
+        return self._replace(args, ks, vs, kv)
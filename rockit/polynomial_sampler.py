@@ -0,0 +1,100 @@
+#
+#     This file is part of rockit.
+#
+#     rockit -- Rapid Optimal Control Kit
+#     Copyright (C) 2019 MECO, KU Leuven. All rights reserved.
+#
+#     Rockit is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU Lesser General Public
+#     License as published by the Free Software Foundation; either
+#     version 3 of the License, or (at your option) any later version.
+#
+#     Rockit is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#     Lesser General Public License for more details.
+#
+#     You should have received a copy of the GNU Lesser General Public
+#     License along with CasADi; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+#
+import numpy as np
+
+
+class PolynomialSampler:
+    """Purely numerical sampler of a piecewise polynomial trajectory
+
+    The coefficients of all integrator intervals are stored in one contiguous array.
+    A call locates the interval with a binary search and evaluates
+    the polynomial with Horner's scheme, writing into a caller-provided buffer.
+
+    Obtain instances through :meth:`~rockit.stage.Stage.polynomial_sampler`
+    or :meth:`~rockit.solution.OcpSolution.polynomial_sampler`.
+    """
+    def __init__(self, grid, coeffs):
+        """
+        Parameters
+        ----------
+        grid : :obj:`numpy.ndarray`
+            Interval boundaries, length n+1
+        coeffs : :obj:`numpy.ndarray`
+            Polynomial coefficients with shape (degree, n, n_out),
+            ordered from the constant term upwards, in local time of the interval
+        """
+        self.grid = np.ascontiguousarray(grid, dtype=float)
+        self.coeffs = np.ascontiguousarray(coeffs, dtype=float)
+        self.degree, self.n, self.n_out = self.coeffs.shape
+        self._tlocal = np.empty(0)
+        self._work = np.empty((0, self.n_out))
+
+    def __call__(self, t, out=None):
+        """
+        Parameters
+        ----------
+        t : float or float vector
+            time or time-points to sample at
+        out : :obj:`numpy.ndarray`, optional
+            Buffer that receives the result:
+            shape (n_out,) for scalar t, (len(t), n_out) for vector t
+
+        Returns
+        -------
+        :obj:`np.array`
+            out, or a newly allocated array if out was not provided
+        """
+        C = self.coeffs
+        if np.ndim(t)==0:
+            i = min(max(int(np.searchsorted(self.grid, t, side='right'))-1, 0), self.n-1)
+            tl = t-self.grid[i]
+            if out is None:
+                out = np.empty(self.n_out)
+            out[:] = C[-1, i]
+            for j in range(self.degree-2, -1, -1):
+                out *= tl
+                out += C[j, i]
+            return out
+
+        t = np.asarray(t, dtype=float).ravel()
+        m = t.shape[0]
+        if out is None:
+            out = np.empty((m, self.n_out))
+        if self._tlocal.shape[0]<m:
+            self._tlocal = np.empty(m)
+            self._work = np.empty((m, self.n_out))
+        tl = self._tlocal[:m]
+        work = self._work[:m]
+
+        i = np.searchsorted(self.grid, t, side='right')
+        np.subtract(i, 1, out=i)
+        np.clip(i, 0, self.n-1, out=i)
+        np.take(self.grid, i, out=tl)
+        np.subtract(t, tl, out=tl)
+        tl = tl[:, None]
+
+        np.take(C[-1], i, axis=0, out=out)
+        for j in range(self.degree-2, -1, -1):
+            out *= tl
+            np.take(C[j], i, axis=0, out=work)
+            out += work
+        return out
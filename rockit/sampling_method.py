@@ -20,13 +20,27 @@
 #
 #
 
-from casadi import integrator, Function, MX, hcat, vertcat, vcat, linspace, veccat, DM, repmat, horzsplit, cumsum, inf, mtimes, symvar, horzcat, symvar, vvcat, is_equal
+from casadi import integrator, Function, MX, hcat, vertcat, vcat, linspace, veccat, DM, repmat, horzsplit, cumsum, inf, mtimes, symvar, horzcat, symvar, vvcat, is_equal, evalf, vec, reshape, substitute
 from .direct_method import DirectMethod
 from .splines import BSplineBasis, BSpline
-from .casadi_helpers import reinterpret_expr, HashOrderedDict
+from .casadi_helpers import reinterpret_expr, HashOrderedDict, BlockList
 from numpy import nan, inf
 import numpy as np
 from collections import defaultdict
+from functools import lru_cache
+from math import comb
+
+@lru_cache(maxsize=None)
+def bernstein_conversion(degree):
+    """Bernstein basis on [0,1] and the matrix that maps power-basis coefficients onto it
+
+    b_i = sum_{j<=i} binom(i,j)/binom(degree,j) a_j
+    """
+    T = np.zeros((degree+1, degree+1))
+    for i in range(degree+1):
+        for j in range(i+1):
+            T[i, j] = comb(i, j)/comb(degree, j)
+    return BSplineBasis([0]*(degree+1)+[1]*(degree+1),degree), DM(T)
 
 # Agnostic about free or fixed start or end point: 
 
@@ -260,16 +274,46 @@ class SamplingMethod(DirectMethod):
         self.P_control = []
         self.P_control_plus = []
 
-        self.poly_coeff = []  # Optional list to save the coefficients for a polynomial
-        self.poly_coeff_z = []  # Optional list to save the coefficients for a polynomial
+        self.poly_coeff = BlockList()  # Optional list to save the coefficients for a polynomial
+        self.poly_coeff_z = BlockList()  # Optional list to save the coefficients for a polynomial
         self.xk = []  # List for intermediate integrator states
         self.zk = []
         self.xr = []
         self.zr = []
         self.tr = []
         self.q = 0
+        self._subst_groups = {}
+        self._subst_plans = {}
+        self._subst_seen = set()
 
     def discrete_system(self, stage):
+        """Discretised system of a single control interval
+
+        Stages with identical dynamics and discretisation settings,
+        such as the sibling stages of a scenario tree, share a single Function.
+        It is cached on the master OptiWrapper.
+        Clones of a template recognise each other without constructing the dynamics;
+        their Function is cached on the template.
+        """
+        settings = (type(self).__name__, self.intg, str(sorted(self.intg_options.items())), self.M)
+        return stage._dynamics_cached(settings, lambda: self._shared_discrete_system(stage, settings))
+
+    def _shared_discrete_system(self, stage, settings):
+        opti = stage.master._method.opti
+        cache = getattr(opti, "discrete_system_cache", None)
+        if cache is None:
+            return self._discrete_system(stage)
+        try:
+            dynamics = stage._diffeq() if stage._state_next else stage._ode()
+            key = settings + (dynamics.serialize(),)
+        except Exception:
+            # E.g. dynamics containing non-serializable callbacks
+            return self._discrete_system(stage)
+        if key not in cache:
+            cache[key] = self._discrete_system(stage)
+        return cache[key]
+
+    def _discrete_system(self, stage):
         # Coefficient matrix from RK4 to reconstruct 4th order polynomial (k1,k2,k3,k4)
         # nstates x (4 * M)
         poly_coeffs = []
@@ -419,18 +463,64 @@ class SamplingMethod(DirectMethod):
         self.set_parameter(stage, opti)
 
 
-    def add_constraints_before(self, stage, opti):
-        for c, meta, args in stage._constraints["point"]:
+    def add_constraints_before(self, stage, opti, constraints=None):
+        if constraints is None: constraints = stage._constraints
+        for c, meta, args in constraints["point"]:
             e = self.eval(stage, c)
             if 'r_at_tf' not in [a.name() for a in symvar(e)]:
                 opti.subject_to(e, args["scale"], meta=meta)
 
-    def add_constraints_after(self, stage, opti):
-        for c, meta, args in stage._constraints["point"]:
+    def add_constraints_after(self, stage, opti, constraints=None):
+        if constraints is None: constraints = stage._constraints
+        for c, meta, args in constraints["point"]:
             e = self.eval(stage, c)
             if 'r_at_tf' in [a.name() for a in symvar(e)]:
                 opti.subject_to(e, args["scale"], meta=meta)
 
+    def add_constraints_integrator(self, stage, opti, k, l, constraints):
+        for c, meta, args in constraints["integrator"]:
+            if k==0 and l==0 and not args["include_first"]: continue
+            opti.subject_to(self.eval_at_integrator(stage, c, k, l), scale=args["scale"], meta=meta)
+        for c, meta, _ in constraints["inf"]:
+            self.add_inf_constraints(stage, opti, c, k, l, meta)
+
+    def add_constraints_control(self, stage, opti, k, constraints):
+        for c, meta, args in constraints["control"]:  # for each constraint expression
+            if k==0 and not args["include_first"]: continue
+            try:
+                opti.subject_to(self.eval_at_control(stage, c, k), scale=args["scale"], meta=meta)
+            except IndexError:
+                pass # Can be caused by ocp.offset -> drop constraint
+
+    def add_constraints_interval(self, stage, opti, k, constraints):
+        for l in range(self.M):
+            self.add_constraints_integrator(stage, opti, k, l, constraints)
+        self.add_constraints_control(stage, opti, k, constraints)
+
+    def add_constraints_last(self, stage, opti, constraints):
+        for c, meta, args in constraints["control"]+constraints["integrator"]:  # for each constraint expression
+            if not args["include_last"]: continue
+            # Add it to the optimizer, but first make x,u concrete.
+            try:
+                opti.subject_to(self.eval_at_control(stage, c, -1), scale=args["scale"], meta=meta)
+            except IndexError:
+                pass # Can be caused by ocp.offset -> drop constraint
+
+    def add_stage_constraints(self, stage, opti, constraints):
+        """Add stage constraints to an existing transcription
+
+        Parameters
+        ----------
+        constraints : dict
+            Lists of stage constraints, keyed by grid
+        """
+        constraints = defaultdict(list, constraints)
+        self.add_constraints_before(stage, opti, constraints)
+        for k in range(self.N):
+            self.add_constraints_interval(stage, opti, k, constraints)
+        self.add_constraints_last(stage, opti, constraints)
+        self.add_constraints_after(stage, opti, constraints)
+
     def add_inf_constraints(self, stage, opti, c, k, l, meta):
         # Query the discretization method used for polynomial coefficients
         #   interpretation: state ~= coeff * [t^0;t^1;t^2;...]
@@ -439,14 +529,12 @@ class SamplingMethod(DirectMethod):
 
         # Represent polynomial as a BSpline object (https://gitlab.kuleuven.be/meco-software/rockit/-/blob/v0.1.28/rockit/splines/spline.py#L392)
         degree = coeff.shape[1]-1
-        basis = BSplineBasis([0]*(degree+1)+[1]*(degree+1),degree)
-        tscale = self.T / self.N / self.M
-        tpower = vcat([tscale**i for i in range(degree+1)])
+        basis, poly_to_bernstein = bernstein_conversion(degree)
+        dt = (self.control_grid[k + 1] - self.control_grid[k])/self.M
+        tpower = vcat([dt**i for i in range(degree+1)])
         coeff = coeff * repmat(tpower.T,stage.nx,1)
-        # TODO: bernstein transformation as function of degree
-        Poly_to_Bernstein_matrix_4 = DM([[1,0,0,0,0],[1,1.0/4, 0, 0, 0],[1, 1.0/2, 1.0/6, 0, 0],[1, 3.0/4, 1.0/2, 1.0/4, 0],[1, 1, 1, 1, 1]])
         # Use a direct way to obtain Bernstein coefficients from polynomial coefficients
-        state_coeff = mtimes(Poly_to_Bernstein_matrix_4,coeff.T)
+        state_coeff = mtimes(poly_to_bernstein,coeff.T)
         
         # Replace symbols for states by BSpline object derivatives
         subst_from = list(stage.states)
@@ -461,7 +549,6 @@ class SamplingMethod(DirectMethod):
 
         # Replace symbols for state derivatives by BSpline object derivatives
         subst_from += stage._inf_der.keys()
-        dt = (self.control_grid[k + 1] - self.control_grid[k])/self.M
         subst_to += [lookup[e].derivative()*(1/dt) for e in stage._inf_der.values()]
 
         subst_from += stage._inf_inert.keys()
@@ -612,8 +699,12 @@ class SamplingMethod(DirectMethod):
         DT_control = self.get_DT_control_at(k)
         DT = self.get_DT_at(k, self.M-1 if k==-1 else 0)
 
-        expr = stage._expr_apply(expr, sub=(subst_from, subst_to), t0=self.t0, T=self.T, x=self.X[k], z=self.Z[k] if self.Z else nan, xq=self.q if k==-1 else nan, u=self.U[k], p_control=self.get_p_control_at(stage, k), p_control_plus=self.get_p_control_plus_at(stage, k), v=self.V, p=veccat(*self.P), v_control=self.get_v_control_at(stage, k),  v_control_plus=self.get_v_control_plus_at(stage, k), v_states=self.get_v_states_at(stage, k), t=self.control_grid[k], DT=DT, DT_control=DT_control)
-        expr = stage.master._method.eval_top(stage.master, expr)
+        kwargs = dict(t0=self.t0, T=self.T, x=self.X[k], z=self.Z[k] if self.Z else nan, xq=self.q if k==-1 else nan, u=self.U[k], p_control=self.get_p_control_at(stage, k), p_control_plus=self.get_p_control_plus_at(stage, k), v=self.V, p=veccat(*self.P), v_control=self.get_v_control_at(stage, k),  v_control_plus=self.get_v_control_plus_at(stage, k), v_states=self.get_v_states_at(stage, k), t=self.control_grid[k], DT=DT, DT_control=DT_control)
+        if subst_from:
+            expr = stage._expr_apply(expr, sub=(subst_from, subst_to), **kwargs)
+            expr = stage.master._method.eval_top(stage.master, expr)
+        else:
+            expr = self._apply_plan(stage, expr, **kwargs)
         #print("expr",expr)
         return expr
     
@@ -644,17 +735,50 @@ class SamplingMethod(DirectMethod):
             DT = self.get_DT_at(len(self.integrator_grid)-1, self.M-1)
         else:
             DT = self.get_DT_at(k, 0)
-        return stage._expr_apply(expr, t0=self.t0, T=self.T, x=x, z=z, xq=self.q if k==-1 else nan, u=u, p_control=p_control, p_control_plus=p_control_plus, v=self.V, p=veccat(*self.P), v_control=v_control, v_control_plus=v_control_plus, v_states=v_states, t=t, DT=DT, DT_control=DT_control)
+        return self._apply_plan(stage, expr, eval_top=False, t0=self.t0, T=self.T, x=x, z=z, xq=self.q if k==-1 else nan, u=u, p_control=p_control, p_control_plus=p_control_plus, v=self.V, p=veccat(*self.P), v_control=v_control, v_control_plus=v_control_plus, v_states=v_states, t=t, DT=DT, DT_control=DT_control)
+
+    def _apply_plan(self, stage, expr, eval_top=True, **kwargs):
+        """Substitute stage symbols, like stage._expr_apply followed by eval_top
+
+        The substitution is compiled into a Function once per expression,
+        which is then inlined at every control or integrator point.
+        """
+        expr = MX(expr)
+        if expr.is_constant():
+            return expr
+        names = tuple(key for key, value in kwargs.items() if value is not None)
+        keep = self._subst_groups.get(names)
+        if keep is None:
+            subst_from, subst_names = stage._get_subst_set(**{n: n for n in names})
+            keep = [(f, n) for f, n in zip(subst_from, subst_names) if f is not None and not f.is_empty()]
+            self._subst_groups[names] = keep
+        key = (hash(expr), eval_top, names)
+        plan = self._subst_plans.get(key)
+        if plan is None and key not in self._subst_seen:
+            # Expressions that are used only once are not worth compiling
+            self._subst_seen.add(key)
+            subst_from, subst_to = [f for f, _ in keep], [MX(kwargs[n]) for _, n in keep]
+            expr = substitute([expr], subst_from, subst_to)[0]
+            return stage.master._method.eval_top(stage.master, expr) if eval_top else expr
+        if plan is None:
+            symbols = [MX.sym(n, f.sparsity()) for f, n in keep]
+            body = substitute([expr], [f for f, _ in keep], symbols)[0]
+            if eval_top:
+                body = stage.master._method.eval_top(stage.master, body)
+            # Keep expr alive, such that its hash cannot be recycled
+            plan = (expr, Function("plan", symbols, [body], {"allow_free": True}))
+            self._subst_plans[key] = plan
+        return plan[1].call([kwargs[n] if isinstance(kwargs[n], MX) else MX(kwargs[n]) for _, n in keep], True, False)[0]
 
     def eval_at_integrator(self, stage, expr, k, i):
         DT_control = self.get_DT_control_at(k)
         DT = self.get_DT_at(k, i)
-        return stage.master._method.eval_top(stage.master, stage._expr_apply(expr, t0=self.t0, T=self.T, x=self.xk[k*self.M + i], z=self.zk[k*self.M + i] if self.zk else nan, u=self.U[k], p_control=self.get_p_control_at(stage, k), p_control_plus=self.get_p_control_plus_at(stage, k), v=self.V, p=veccat(*self.P), v_control=self.get_v_control_at(stage, k), v_control_plus=self.get_v_control_plus_at(stage, k), v_states=self.get_v_states_at(stage, k), t=self.integrator_grid[k][i], DT=DT, DT_control=DT_control))
+        return self._apply_plan(stage, expr, t0=self.t0, T=self.T, x=self.xk[k*self.M + i], z=self.zk[k*self.M + i] if self.zk else nan, u=self.U[k], p_control=self.get_p_control_at(stage, k), p_control_plus=self.get_p_control_plus_at(stage, k), v=self.V, p=veccat(*self.P), v_control=self.get_v_control_at(stage, k), v_control_plus=self.get_v_control_plus_at(stage, k), v_states=self.get_v_states_at(stage, k), t=self.integrator_grid[k][i], DT=DT, DT_control=DT_control)
 
     def eval_at_integrator_root(self, stage, expr, k, i, j):
         DT_control = self.get_DT_control_at(k)
         DT = self.get_DT_at(k, i)
-        return stage.master._method.eval_top(stage.master, stage._expr_apply(expr, t0=self.t0, T=self.T, x=self.xr[k][i][:,j], z=self.zr[k][i][:,j] if self.zk else nan, u=self.U[k], p_control=self.get_p_control_at(stage, k), p_control_plus=self.get_p_control_plus_at(stage, k),v=self.V, p=veccat(*self.P), v_control=self.get_v_control_at(stage, k), v_control_plus=self.get_v_control_plus_at(stage, k),t=self.tr[k][i][j], DT=DT, DT_control=DT_control))
+        return self._apply_plan(stage, expr, t0=self.t0, T=self.T, x=self.xr[k][i][:,j], z=self.zr[k][i][:,j] if self.zk else nan, u=self.U[k], p_control=self.get_p_control_at(stage, k), p_control_plus=self.get_p_control_plus_at(stage, k),v=self.V, p=veccat(*self.P), v_control=self.get_v_control_at(stage, k), v_control_plus=self.get_v_control_plus_at(stage, k),t=self.tr[k][i][j], DT=DT, DT_control=DT_control)
 
     def set_initial(self, stage, master, initial):
         opti = master.opti if hasattr(master, 'opti') else master
@@ -665,9 +789,16 @@ class SamplingMethod(DirectMethod):
             if is_equal(var, stage.t0):
                 var = self.t0
             opti_initial = opti.initial()
-            for k in list(range(self.N))+[-1]:
-                target = self.eval_at_control(stage, var, k)
-                value = DM(opti.debug.value(self.eval_at_control(stage, expr, k), opti_initial)) # HOT line
+            ks = self.initial_points(stage, var)
+            targets = [self.eval_at_control(stage, var, k) for k in ks]
+            if MX(expr).is_constant():
+                values = [DM(evalf(expr))]*len(ks)
+            else:
+                # Evaluate the guess for all control points in a single call
+                exprs = [self.eval_at_control(stage, expr, k) for k in ks]
+                values = reshape(DM(opti.debug.value(hcat([vec(e) for e in exprs]), opti_initial)), -1, len(ks))
+                values = [reshape(values[:, j], e.shape) for j, e in enumerate(exprs)]
+            for k, target, value in zip(ks, targets, values):
                 if target.numel()*(self.N)==value.numel():
                     if repmat(target, self.N, 1).shape==value.shape:
                         value = value[k,:]
@@ -681,6 +812,10 @@ class SamplingMethod(DirectMethod):
                         value = value[:,k]
                 opti.set_initial(target, value, cache_advanced=True)
 
+    def initial_points(self, stage, var):
+        """Control points at which an initial guess for var is imposed"""
+        return list(range(self.N))+[-1]
+
     def set_value(self, stage, master, parameter, value):
         opti = master.opti if hasattr(master, 'opti') else master
         found = False
@@ -698,6 +833,26 @@ class SamplingMethod(DirectMethod):
                 opti.set_value(hcat(self.P_control_plus[i]), value)
         assert found, "You attempted to set the value of a non-parameter."
 
+    def parameter_symbols(self, stage, parameter):
+        for i, p in enumerate(stage.parameters['control']):
+            if is_equal(parameter, p):
+                return self.P_control[i]
+        for i, p in enumerate(stage.parameters['control+']):
+            if is_equal(parameter, p):
+                return self.P_control_plus[i]
+        return DirectMethod.parameter_symbols(self, stage, parameter)
+
+    def interval_variables(self):
+        """Decision variables that repeat over the control intervals
+
+        Returns
+        -------
+        list of tuple
+            (sequence, stride) pairs: entries k and k+stride of sequence
+            play the same role, one control interval apart
+        """
+        return [(self.U, 1)] + [(v, 1) for v in self.V_control + self.V_control_plus + self.V_states]
+
     def add_parameter(self, stage, opti):
         for p in stage.parameters['']:
             self.P.append(opti.parameter(p.shape[0], p.shape[1]))
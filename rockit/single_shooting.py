@@ -72,9 +72,9 @@ class SingleShooting(SamplingMethod):
                 self.Z.append(zk_temp[:, 0])
             self.Z.append(FF["zf"])
             if self.poly_coeff is not None:
-                self.poly_coeff.extend(horzsplit(poly_coeff_temp, poly_coeff_temp.shape[1]//self.M))
+                self.poly_coeff.extend_blocks(poly_coeff_temp, self.M)
             if self.poly_coeff_z is not None:
-                self.poly_coeff_z.extend(horzsplit(poly_coeff_z_temp, poly_coeff_z_temp.shape[1]//self.M))
+                self.poly_coeff_z.extend_blocks(poly_coeff_z_temp, self.M)
             FFs.append(FF)
 
         self.xk.append(self.X[-1])
@@ -86,24 +86,6 @@ class SingleShooting(SamplingMethod):
             # Save intermediate info
             self.q = self.q + FF["qf"]
 
-            for l in range(self.M):
-                for c, meta, args in stage._constraints["integrator"]:
-                    if k==0 and l==0 and not args["include_first"]: continue
-                    opti.subject_to(self.eval_at_integrator(stage, c, k, l), scale=args["scale"], meta=meta)
-                for c, meta, _ in stage._constraints["inf"]:
-                    self.add_inf_constraints(stage, opti, c, k, l, meta)
+            self.add_constraints_interval(stage, opti, k, stage._constraints)
 
-            for c, meta, args in stage._constraints["control"]:  # for each constraint expression
-                if k==0 and not args["include_first"]: continue
-                try:
-                    opti.subject_to(self.eval_at_control(stage, c, k), scale=args["scale"], meta=meta)
-                except IndexError:
-                    pass # Can be caused by ocp.offset -> drop constraint
-
-        for c, meta, args in stage._constraints["control"]+stage._constraints["integrator"]:  # for each constraint expression
-            if not args["include_last"]: continue
-            # Add it to the optimizer, but first make x,u concrete.
-            try:
-                opti.subject_to(self.eval_at_control(stage, c, -1), scale=args["scale"], meta=meta)
-            except IndexError:
-                pass # Can be caused by ocp.offset -> drop constraint
+        self.add_constraints_last(stage, opti, stage._constraints)
@@ -21,8 +21,8 @@
 #
 
 import numpy as np
-from casadi import vertcat, vcat, DM, Function, hcat, MX
-from .casadi_helpers import DM2numpy
+from casadi import vertcat, vcat, vvcat, DM, Function, hcat, MX, vec, jacobian, hessian, gradient, dot, solve, jacobian_sparsity
+from .casadi_helpers import DM2numpy, DM2native
 from numpy import nan
 import functools
 
@@ -82,9 +82,68 @@ class OcpSolution:
         >>> sol = ocp.solve()
         >>> tx, xs = sol.sample(x, grid='control')
         """
-        time, res = self.stage.sample(expr, grid, **kwargs)
-        res = self.sol.value(res)
-        return self.sol.value(time), DM2numpy(res, MX(expr).shape, time.numel())
+        f = self.stage._sample_function(expr, grid, **kwargs)
+        if f is None:
+            time, res = self.stage.sample(expr, grid, **kwargs)
+            res = self.sol.value(res)
+            return self.sol.value(time), DM2numpy(res, MX(expr).shape, time.numel())
+        time, res = f(self._gist)
+        return DM2native(time), DM2numpy(res, MX(expr).shape, time.numel())
+
+    def sample_many(self, exprs, grid, **kwargs):
+        """Sample several expressions at solution on a common grid.
+
+        All expressions are evaluated together, with a single numerical evaluation.
+
+        Parameters
+        ----------
+        exprs : dict
+            Arbitrary expressions containing states, controls, ..., keyed by name
+        grid : `str`
+            At which points in time to sample, options are
+            'control' or 'integrator' (at integrator discretization
+            level) or 'integrator_roots'.
+        refine : int, optional
+            Refine grid by evaluation the polynomal of the integrater at
+            intermediate points ("refine" points per interval).
+
+        Returns
+        -------
+        time : numpy.ndarray
+            Time from zero to final time, shared by all expressions
+        res : dict of numpy.ndarray
+            Numerical values of evaluated expressions at points in time vector,
+            keyed like exprs.
+
+        Examples
+        --------
+        Assume an ocp with a stage is already defined.
+
+        >>> sol = ocp.solve()
+        >>> tx, res = sol.sample_many({"x": x, "u": u}, grid='control')
+        >>> res["x"]
+        """
+        names = list(exprs.keys())
+        exprs = [MX(exprs[name]) for name in names]
+        n = sum(e.numel() for e in exprs)
+        f = self.stage._sample_function(exprs, grid, **kwargs)
+        if f is None:
+            time, res = self.stage.sample(vvcat(exprs), grid, **kwargs)
+            time, res = self.sol.value(time), self.sol.value(res)
+        else:
+            time, res = f(self._gist)
+            time = DM2native(time)
+        res = np.array(res).reshape(n, -1)
+        tdim = np.size(time)
+        ret = {}
+        offset = 0
+        for name, e in zip(names, exprs):
+            block = res[offset:offset+e.numel(), :]
+            offset += e.numel()
+            # Columns hold the vectorized (column-major) expression at each time point
+            block = np.transpose(block.T.reshape(tdim, e.shape[1], e.shape[0]), [0, 2, 1])
+            ret[name] = block.reshape((tdim,)+tuple([d for d in e.shape if d!=1]))
+        return time, ret
 
     def sampler(self, *args):
         """Returns a function that samples given expressions
@@ -135,6 +194,157 @@ class OcpSolution:
                 """
         return ret
 
+    def polynomial_sampler(self, exprs):
+        """Returns a purely numerical sampler for given expressions
+
+        All coefficients are extracted from the solution once;
+        calls evaluate the piecewise polynomial into a caller-provided buffer.
+
+        Parameters
+        ----------
+        exprs : :obj:`casadi.MX` or list of :obj:`casadi.MX`
+            Expressions affine in time, states, algebraic states and controls
+
+        Returns
+        -------
+        :obj:`~rockit.polynomial_sampler.PolynomialSampler`
+            (t, out=None) -> output
+
+        Examples
+        --------
+        Assume an ocp with a stage is already defined.
+
+        >>> sol = ocp.solve()
+        >>> s = sol.polynomial_sampler([x, u])
+        >>> buf = np.zeros(2)
+        >>> s(1.0, out=buf) # Value of x and u at t=1.0, written into buf
+        """
+        return self.stage.polynomial_sampler(exprs, self.gist)
+
+    def _kkt(self):
+        """Linearization of the KKT conditions at the solution
+
+        Returns
+        -------
+        K : :obj:`casadi.DM`
+            KKT matrix, restricted to the active constraints
+        rhs : :obj:`casadi.DM`
+            Negative derivative of the KKT conditions with respect to the NLP parameters
+        active : :obj:`numpy.ndarray`
+            Indices of the active constraints
+        values : list of :obj:`numpy.ndarray`
+            Primal variables, parameters and constraint multipliers at the solution
+        """
+        if not hasattr(self.sol, "opti_wrapper"):
+            raise Exception("Sensitivities are only available for Opti-based transcriptions.")
+        opti = self.sol.opti_wrapper
+        advanced = opti.advanced
+        x, p, lam_g = advanced.x, advanced.p, advanced.lam_g
+        if opti.kkt_function is None:
+            lam = MX.sym("lam_g", advanced.g.sparsity())
+            lag = advanced.f+dot(lam, advanced.g)
+            opti.kkt_function = Function("kkt", [x, p, lam],
+                [hessian(lag, x)[0], jacobian(gradient(lag, x), p), jacobian(advanced.g, x), jacobian(advanced.g, p),
+                 advanced.g, advanced.lbg, advanced.ubg, jacobian(advanced.lbg, p), jacobian(advanced.ubg, p)])
+        symbols = [x, p, lam_g]
+        values = np.array(self.sol.sol.value(vertcat(*symbols))).ravel()
+        values = np.split(values, np.cumsum([e.numel() for e in symbols[:-1]]))
+        H, H_p, A, A_p, g, lbg, ubg, lbg_p, ubg_p = opti.kkt_function(*values)
+
+        # Active set: equality constraints, and inequalities with a multiplier
+        # that exceeds the distance to the bound (robust against interior-point solutions)
+        lam = values[2]
+        g, lbg, ubg = [np.array(e).ravel() for e in (g, lbg, ubg)]
+        lower = -lam>g-lbg
+        active = np.nonzero((lbg==ubg) | lower | (lam>ubg-g))[0]
+        bound_p = ubg_p[active.tolist(), :]
+        lower_p = lbg_p[active.tolist(), :]
+        for i, e in enumerate(active):
+            if lower[e]: bound_p[i, :] = lower_p[i, :]
+
+        A_a = A[active.tolist(), :]
+        n_a = active.size
+        K = vertcat(hcat([H, A_a.T]), hcat([A_a, DM(n_a, n_a)]))
+        rhs = -vertcat(H_p, A_p[active.tolist(), :]-bound_p)
+        return K, rhs, active, values
+
+    def _parameter_index(self, parameter):
+        advanced = self.sol.opti_wrapper.advanced
+        symbols = self.stage._method.parameter_symbols(self.stage, parameter)
+        if not isinstance(symbols, list): symbols = [symbols]
+        sp = jacobian_sparsity(vcat([vec(e) for e in symbols]), advanced.p)
+        return np.array(sp.get_triplet()[1])
+
+    def sensitivity(self, parameter):
+        """First-order sensitivity of the primal-dual solution with respect to a parameter
+
+        Obtained from the KKT system at the solution, assuming that the active set does not change.
+
+        Parameters
+        ----------
+        parameter : :obj:`casadi.MX`
+            Parameter of the problem
+
+        Returns
+        -------
+        dx : :obj:`numpy.ndarray`
+            Derivative of all decision variables of the NLP, one column per parameter entry
+        dlam_g : :obj:`numpy.ndarray`
+            Derivative of all constraint multipliers of the NLP, one column per parameter entry
+        """
+        K, rhs, active, values = self._kkt()
+        index = self._parameter_index(parameter)
+        d = np.array(solve(K, rhs[:, index.tolist()], "qr"))
+        n_x = values[0].size
+        dlam_g = np.zeros((values[2].size, index.size))
+        dlam_g[active, :] = d[n_x:, :]
+        return d[:n_x, :], dlam_g
+
+    def predict(self, values, warm_start=True):
+        """Tangential predictor of the solution for new parameter values
+
+        Parameters
+        ----------
+        values : dict
+            New value for each of the parameters that change
+        warm_start : bool, optional
+            Use the predicted primal and dual variables as initial guess for the next solve
+            Default: True
+
+        Returns
+        -------
+        :obj:`~rockit.solution.OcpSolution`
+            The first-order prediction of the solution
+
+        Examples
+        --------
+
+        >>> sol = ocp.solve()
+        >>> pred = sol.predict({b: 1.1})
+        >>> ocp.set_value(b, 1.1)
+        >>> sol = ocp.solve() # Warm started from pred
+        """
+        from .direct_method import OptiSolCached, OptiSolWrapper
+        K, rhs, active, (x, p, lam_g) = self._kkt()
+        p_new = np.array(p)
+        for parameter, value in values.items():
+            index = self._parameter_index(parameter)
+            p_new[index] = np.array(vec(DM(value))).ravel()
+        dp = p_new-p
+        changed = np.nonzero(dp)[0].tolist()
+        d = np.array(solve(K, DM(rhs[:, changed] @ DM(dp[changed])), "qr")).ravel()
+        x_new = x+d[:x.size]
+        lam_g_new = np.array(lam_g)
+        lam_g_new[active] += d[x.size:]
+
+        opti = self.sol.opti_wrapper
+        advanced = opti.advanced
+        if warm_start:
+            opti.set_initial(advanced.x, x_new)
+            opti.set_initial(advanced.lam_g, lam_g_new)
+        sol = OptiSolCached(advanced, self.stats, [advanced.x, advanced.p, advanced.lam_g], [DM(x_new), DM(p_new), DM(lam_g_new)])
+        return OcpSolution(OptiSolWrapper(opti, sol), self.stage)
+
     @property
     def gist(self):
         """All numerical information needed to compute any value/sample
@@ -30,6 +30,9 @@ from collections import defaultdict
 from .casadi_helpers import vcat, ConstraintInspector, linear_coeffs, reshape_number
 
 class SplineMethod(SamplingMethod):
+    # Variables depend on the refine settings of constraints
+    incremental = False
+
     def __init__(self, **kwargs):
         SamplingMethod.__init__(self, **kwargs)
         self.clean()
@@ -21,10 +21,10 @@
 #
 from casadi import MX, substitute, Function, vcat, depends_on, vertcat, jacobian, veccat, jtimes, hcat,\
                    linspace, DM, constpow, mtimes, low, floor, hcat, horzcat, DM, is_equal, \
-                   Sparsity
+                   Sparsity, vec, repmat, is_linear, evalf
 from rockit.grouping_techniques import GroupingTechnique
 from .freetime import FreeTime
-from .direct_method import DirectMethod
+from .direct_method import DirectMethod, ParameterHandle
 from .multiple_shooting import MultipleShooting
 from .single_shooting import SingleShooting
 from collections import defaultdict
@@ -88,6 +88,8 @@ class Stage:
         self._scale = HashDict()
         self._var_original = None
         self._var_augmented = None
+        self._template = None
+        self._var_dynamics_cache = OrderedDict()
 
         self._param_vals = HashDict()
         self._state_der = HashDict()
@@ -119,6 +121,11 @@ class Stage:
     def master(self):
         return self._master
 
+    @property
+    def _debug_meta(self):
+        # None defers to the global default, see set_debug_meta
+        return getattr(self.master, "_var_debug_meta", None)
+
     @property
     def t(self):
         return self._t
@@ -222,7 +229,7 @@ class Stage:
 
         name = "q"+str(len(self.qstates)+1) if quad else "x"+str(len(self.states)+1)
         x = MX.sym(name, n_rows, n_cols)
-        meta = merge_meta(meta, get_meta())
+        meta = merge_meta(meta, get_meta(debug=self._debug_meta))
         return self.register_state(x, meta=meta, quad=quad, scale=scale)
         
     def register_state(self, x, quad=False, scale=1, meta=None):
@@ -230,7 +237,7 @@ class Stage:
             for e in x:
                 self.register_state(e, quad=quad, scale=scale, meta=meta)
             return
-        self._meta[x] = merge_meta(meta, get_meta())
+        self._meta[x] = merge_meta(meta, get_meta(debug=self._debug_meta))
         self._scale[x] = self._parse_scale(x, scale)
         if quad:
             self._catalog[x] = {"type": 'qstates', "sparsity": x.sparsity()}
@@ -261,7 +268,7 @@ class Stage:
         """
         # Create a placeholder symbol with a dummy name (see #25)
         z = MX.sym("z", n_rows, n_cols)
-        meta = merge_meta(meta, get_meta())
+        meta = merge_meta(meta, get_meta(debug=self._debug_meta))
         return self.register_algebraic(z, scale=scale, meta=meta)
 
     def register_algebraic(self, z, scale=1, meta=None):
@@ -269,7 +276,7 @@ class Stage:
             for e in z:
                 self.register_algebraic(e, scale=scale, meta=meta)
             return
-        self._meta[z] = merge_meta(meta, get_meta())
+        self._meta[z] = merge_meta(meta, get_meta(debug=self._debug_meta))
         self._scale[z] = self._parse_scale(z, scale)
         self._catalog[z] = {"type": 'algebraics', "sparsity": z.sparsity()}
         self.algebraics.append(z)
@@ -313,7 +320,7 @@ class Stage:
         # Create a placeholder symbol with a dummy name (see #25)
         L = sum([len(e) for e in self.variables.values()])
         v = MX.sym("v"+str(L+1), n_rows, n_cols)
-        meta = merge_meta(meta, get_meta())
+        meta = merge_meta(meta, get_meta(debug=self._debug_meta))
         return self.register_variable(v, grid=grid, scale=scale, meta=meta, include_last=include_last)
 
     def register_variable(self, v, grid = '', scale=1, include_last=False, meta=None):
@@ -321,7 +328,7 @@ class Stage:
             for e in v:
                 self.register_variable(e, scale=scale)
             return
-        self._meta[v] = merge_meta(meta, get_meta())
+        self._meta[v] = merge_meta(meta, get_meta(debug=self._debug_meta))
         self._scale[v] = self._parse_scale(v, scale)
         self._catalog[v] = {"type": 'variables', "sparsity": v.sparsity(), "grid": grid, "include_last": include_last}
         if include_last:
@@ -383,7 +390,7 @@ class Stage:
         # Create a placeholder symbol with a dummy name (see #25)
         L = sum([len(e) for e in self.parameters.values()])
         p = MX.sym("p"+str(L+1), n_rows, n_cols)
-        meta = merge_meta(meta, get_meta())
+        meta = merge_meta(meta, get_meta(debug=self._debug_meta))
         return self.register_parameter(p, grid=grid, scale=scale, include_last=include_last, meta=meta)
 
     def register_parameter(self, p, grid='', scale=1, include_last=False, meta=None):
@@ -391,7 +398,7 @@ class Stage:
             for e in p:
                 self.register_parameter(e, scale=scale)
             return
-        self._meta[p] = merge_meta(meta, get_meta())
+        self._meta[p] = merge_meta(meta, get_meta(debug=self._debug_meta))
         self._scale[p] = self._parse_scale(p, scale)
         self._catalog[p] = {"type": 'variables', "sparsity": p.sparsity(), "grid": grid, "include_last": include_last}
         if include_last:
@@ -436,7 +443,7 @@ class Stage:
             return u
 
         u = MX.sym("u", n_rows, n_cols)
-        meta = merge_meta(meta, get_meta())
+        meta = merge_meta(meta, get_meta(debug=self._debug_meta))
         self.register_control(u, scale=scale, meta=meta)
         return u
 
@@ -445,7 +452,7 @@ class Stage:
             for e in u:
                 self.register_control(e, scale=scale)
             return
-        self._meta[u] = merge_meta(meta, get_meta())
+        self._meta[u] = merge_meta(meta, get_meta(debug=self._debug_meta))
         self._scale[u] = self._parse_scale(u, scale)
         self._catalog[u] = {"type": 'controls', "sparsity": u.sparsity()}
         self.controls.append(u)
@@ -486,6 +493,37 @@ class Stage:
                 self._param_vals[parameter] = value
         for_all_primitives(parameter, value, action, "First argument to set_value must be a parameter or a simple concatenation of parameters", rhs_type=DM)
 
+    def parameter_setter(self, parameters):
+        """Obtain a fast setter for the values of a fixed list of parameters
+
+        Intended for repeated updates, e.g. in an MPC loop.
+        In contrast to :meth:`set_value`, parameters are looked up only once.
+        Values set this way are retained when the problem is transcribed anew.
+
+        Parameters
+        ----------
+        parameters : list of :obj:`~casadi.MX`
+            Parameter symbols
+
+        Returns
+        -------
+        setter : callable
+            Call with one value for each parameter
+
+        Examples
+        --------
+
+        >>> ocp = Ocp()
+        >>> p = ocp.parameter()
+        >>> w = ocp.parameter(grid='control')
+        >>> setter = ocp.parameter_setter([p, w])
+        >>> setter(3, 0.5)
+        """
+        for p in parameters:
+            if not np.any([p in e for e in self.parameters.values()]):
+                raise Exception("You attempted to set the value of a non-parameter. Got " + str(p))
+        return ParameterHandle(self, parameters)
+
 
     def set_initial(self, var, value, priority=True):
         """Provide an initial guess
@@ -701,7 +739,7 @@ class Stage:
         """
         Remove any previously declared constraints from the problem
         """
-        self._set_transcribed(False)
+        self._set_transcribed(False, 'constraints')
         self._constraints = defaultdict(list)
 
     def subject_to(self, constr, grid=None,include_first=True,include_last=True,scale=1,refine=1,group_refine=GroupingTechnique(),group_dim=GroupingTechnique(),group_control=GroupingTechnique(),meta=None):
@@ -749,7 +787,7 @@ class Stage:
         >>> ocp.subject_to( ocp.at_t0(x) == 0)  # boundary constraint
         >>> ocp.subject_to( ocp.at_tf(x) == 0)  # boundary constraint
         """
-        self._set_transcribed(False)
+        self._set_transcribed(False, 'constraints')
         #import ipdb; ipdb.set_trace()
         if grid is None:
             grid = 'control' if self.is_signal(constr) else 'point'
@@ -764,7 +802,7 @@ class Stage:
         
         scale = self._parse_scale(constr, scale)
         args = {"grid": grid, "include_last": include_last, "include_first": include_first, "scale": scale, "refine": refine, "group_refine": group_refine, "group_dim": group_dim, "group_control": group_control}
-        self._constraints[grid].append((constr, get_meta(meta), args))
+        self._constraints[grid].append((constr, get_meta(meta, debug=self._debug_meta), args))
 
     def at_t0(self, expr):
         """Evaluate a signal at the start of the horizon
@@ -833,7 +871,7 @@ class Stage:
 
         """
         assert not self.is_signal(term), "An objective cannot be a signal. You must use ocp.integral or ocp.at_t0/tf to remove the time-dependence"
-        self._set_transcribed(False)
+        self._set_transcribed(False, 'objective')
         self._objective = self._objective + term
         if not MX(term).is_scalar():
             raise Exception("Objective terms must be scalar, got " + str(MX(term).dim())+ ".")
@@ -1027,8 +1065,58 @@ class Stage:
             len_after = len(self._placeholders)
             if len_before==len_after: break
 
+    def _dynamics_ingredients(self):
+        """All expressions that enter _ode and _diffeq, in groups
+
+        Quadrature states themselves are not inputs of those Functions; only their derivatives matter.
+        """
+        der = {hash(k): v for k, v in self._state_der.items()}
+        nxt = {hash(k): v for k, v in self._state_next.items()}
+        states = list(self.states)+list(self.qstates)
+        return (tuple(self.states), tuple(self.controls), tuple(self.algebraics),
+                tuple(self.parameters['']+self.parameters['control']+self.parameters['control+']),
+                tuple(self.variables['']+self.variables['control']+self.variables['control+']),
+                tuple(der.get(hash(k)) for k in states), tuple(self._alg),
+                tuple(nxt.get(hash(k)) for k in states))
+
+    # Maximum number of Functions kept by _dynamics_cached
+    _dynamics_cache_capacity = 64
+
+    def _dynamics_cached(self, name, construct):
+        """Cache a Function that depends on the dynamics only
+
+        Clones of a template share a cache that lives on the template.
+        Entries are keyed by the node identities of the dynamics,
+        such that clones that alter their dynamics get their own entry.
+        The cache holds on to the expressions, such that identities cannot be recycled.
+        Least recently used entries are evicted, such that stale dynamics of
+        a long-lived template do not accumulate.
+        """
+        owner = self._template or self
+        cache = owner._var_dynamics_cache
+        ingredients = self._dynamics_ingredients()
+        def identity(e):
+            if e is None: return None
+            # Numeric right-hand sides have no node
+            return hash(e) if isinstance(e, MX) else str(DM(e))
+        key = (name, tuple(tuple(identity(e) for e in g) for g in ingredients))
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key][1]
+        ret = construct()
+        cache[key] = (ingredients, ret)
+        while len(cache)>self._dynamics_cache_capacity:
+            cache.popitem(last=False)
+        return ret
+
     # Internal methods
     def _ode(self):
+        return self._dynamics_cached('ode', self._construct_ode)
+
+    def _diffeq(self):
+        return self._dynamics_cached('diffeq', self._construct_diffeq)
+
+    def _construct_ode(self):
         der = []
         for k in self.states:
             try:
@@ -1054,8 +1142,7 @@ class Stage:
         assert not ret.has_free()
         return ret
 
-    # Internal methods
-    def _diffeq(self):
+    def _construct_diffeq(self):
         val = []
         for k in self.states:
             try:
@@ -1171,10 +1258,18 @@ class Stage:
         else:
             return self
 
-    def _set_transcribed(self, val):
+    def _set_transcribed(self, val, component='structure'):
+        """
+        component: which part of the problem got modified
+          'structure' (variables, dynamics, method,...), 'constraints' or 'objective'
+        """
         if self.master:
             if self._is_original:
                 self.master._var_is_transcribed = val
+                if val:
+                    self.master._var_dirty.clear()
+                else:
+                    self.master._var_dirty.add(component)
 
     """
         In fact, both the original and the augmented should separately kee a transcribed flag
@@ -1273,7 +1368,7 @@ class Stage:
         ret._constraints = defaultdict(list)
         for k in constr_types:
             v = self._constraints[k]
-            ret._constraints[k] = list(zip(r, [merge_meta(m, get_meta()) for _, m, _ in v], [d for _, _, d in v]))
+            ret._constraints[k] = list(zip(r, [merge_meta(m, get_meta(debug=ret._debug_meta)) for _, m, _ in v], [d for _, _, d in v]))
             r = r[len(v):]
 
         ret._initial = HashOrderedDict(zip(res[n_constr+1:], self._initial.values()))
@@ -1286,6 +1381,7 @@ class Stage:
         ret._method.T = None
         ret._method.t0 = None
         ret._var_original = self._var_original
+        ret._template = self
 
         ret._meta = self._meta
         ret._scale = self._scale
@@ -1294,21 +1390,40 @@ class Stage:
         ret._var_is_transcribed = False
         return ret
 
+    # Attributes that are shared between a stage and its augmented copy
+    _augment_shared = ("_method", "_template", "_var_dynamics_cache", "_transcribed_placeholders")
+    # Containers that augmentation mutates: copied, contents shared
+    _augment_copied = ("states", "qstates", "controls", "algebraics", "_meta", "_scale", "_catalog",
+                       "_param_vals", "_state_der", "_scale_der", "_state_next", "_alg", "_initial",
+                       "_placeholders", "_offsets", "_inf_inert", "_inf_der", "_var_dirty")
+    # Idem, for containers of containers
+    _augment_copied_nested = ("parameters", "variables", "_constraints")
+
     def __deepcopy__(self, memo):
-        # Get default deepcopy behaviour
+        """Augmented copy of a stage tree
+
+        Expressions, metadata and the transcription method are shared with the original.
+        Only containers that augmentation mutates are copied.
+        """
         import copy
-        deepcopy_method = self.__deepcopy__
-        self.__deepcopy__ = None
-        cp = copy.deepcopy(self, memo)
-        self.__deepcopy__ = deepcopy_method
-        cp.__deepcopy__ = deepcopy_method
+        cp = self.__class__.__new__(self.__class__)
+        memo[id(self)] = cp
+        for k, v in self.__dict__.items():
+            if k=="_var_augmented":
+                v = None
+            elif k in self._augment_shared or isinstance(v, MX):
+                pass
+            elif k in self._augment_copied:
+                v = copy.copy(v)
+            elif k in self._augment_copied_nested:
+                v = defaultdict(v.default_factory, {kk: copy.copy(vv) for kk, vv in v.items()})
+            else:
+                v = copy.deepcopy(v, memo)
+            cp.__dict__[k] = v
 
-        # Custom amendments
         cp._var_original = self
         self._var_augmented = cp
 
-        cp._method = self._method
-
         return cp
 
     def iter_stages(self, include_self=False):
@@ -1383,6 +1498,65 @@ class Stage:
 
         return placeholders(time), placeholders(res)
 
+    # Maximum number of compiled samplers kept by _sample_function
+    _sample_cache_capacity = 128
+
+    @transcribed
+    def _sample_function(self, expr, grid='control', **kwargs):
+        """Function mapping the gist to sampled time and values
+
+        A list of expressions is sampled as one vertically stacked column (veccat).
+        Memoized per transcription, with least-recently-used eviction.
+        Expressions are keyed by node identity: symbols are cached right away,
+        other expressions only once the same node is sampled a second time,
+        such that freshly built expressions do not evict useful entries.
+
+        Returns
+        -------
+        :obj:`casadi.Function` or None
+            None if the samples cannot be expressed in terms of the gist,
+            or are not worth caching (yet)
+        """
+        opti = getattr(self.master._method, "opti", None)
+        cache = getattr(opti, "sample_cache", None)
+        if cache is None:
+            return None
+        if isinstance(expr, list):
+            expr = [MX(e) for e in expr]
+            expr_hash = tuple(hash(e) for e in expr)
+            symbolic = all(e.is_symbolic() for e in expr)
+        else:
+            expr = MX(expr)
+            expr_hash = hash(expr)
+            symbolic = expr.is_symbolic()
+        try:
+            key = (self, expr_hash, grid, tuple(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:
+            return None
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key][1]
+        if not symbolic:
+            seen = opti.sample_seen
+            if key not in seen:
+                # Keep expr alive, such that its hash cannot be recycled
+                seen[key] = expr
+                while len(seen)>self._sample_cache_capacity:
+                    seen.popitem(last=False)
+                return None
+            del seen[key]
+        time, res = self.sample(veccat(*expr) if isinstance(expr, list) else expr, grid, **kwargs)
+        try:
+            f = Function("sample", [self.master.gist], [time, res])
+        except Exception:
+            f = None
+        # Keep expr alive, such that its hash cannot be recycled
+        cache[key] = (expr, f)
+        while len(cache)>self._sample_cache_capacity:
+            cache.popitem(last=False)
+        return f
+
     def _grid_gist(self, stage, expr, grid, include_first=True, include_last=True, transpose=False, refine=1):
         if hasattr(stage._method,"grid_gist"):
             return stage._method.grid_gist(self, expr, grid, include_first=include_first, include_last=include_last, transpose=transpose, refine=refine)
@@ -1443,49 +1617,58 @@ class Stage:
         if stage._method.poly_coeff is None:
             msg = "No polynomal coefficients for the {} integration method".format(stage._method.intg)
             raise Exception(msg)
-        N, M = stage._method.N, stage._method.M
+        method = stage._method
+        N, M = method.N, method.M
 
         expr_f = Function('expr', [stage.t, stage.x, stage.z, stage.u, vertcat(stage.p, stage.v), stage.t0, stage.T], [expr])
         assert not expr_f.has_free(), str(expr_f.free_mx())
 
-        time = stage._method.control_grid
-        total_time = []
-        sub_expr = []
+        # Evaluation of the integrator polynomial at given fractions of a single integration interval
+        has_z = bool(method.poly_coeff_z)
+        coeff = method.poly_coeff[0]
+        t0 = MX.sym("t0")
+        dt = MX.sym("dt")
+        c = MX.sym("c", coeff.sparsity())
+        u = MX.sym("u", method.U[0].sparsity())
+        p = MX.sym("p", method.get_p_sys(stage, 0).sparsity())
+        t0_stage = MX.sym("t0_stage", MX(method.t0).sparsity())
+        T_stage = MX.sym("T_stage", MX(method.T).sparsity())
+        syms = [t0, dt, c, u, p, t0_stage, T_stage]
+        if has_z:
+            c_z = MX.sym("c_z", method.poly_coeff_z[0].sparsity())
+            syms.append(c_z)
+        def interval(fractions):
+            ts = dt*DM(fractions).T
+            tpower = vcat([constpow(ts,i) for i in range(coeff.shape[1])])
+            z = mtimes(c_z, vcat([constpow(ts,i) for i in range(c_z.shape[1])])) if has_z else nan
+            return Function('interval', syms, [expr_f(t0+ts, mtimes(c,tpower), z, u, p, t0_stage, T_stage)])
+
+        # All integration intervals at once
+        time = method.control_grid
+        t0s, dts, us, ps = [], [], [], []
         for k in range(N):
-            t0 = time[k]
-            dt = (time[k+1]-time[k])/M
-            tlocal = linspace(MX(0), dt, refine + 1)
-            assert tlocal.is_column()
-            ts = tlocal[:-1,:]
+            h = (time[k+1]-time[k])/M
+            pv = method.get_p_sys(stage,k)
             for l in range(M):
-                local_t = t0+tlocal[:-1]
-                total_time.append(local_t)
-                coeff = stage._method.poly_coeff[k * M + l]
-                tpower = hcat([constpow(ts,i) for i in range(coeff.shape[1])]).T
-                if stage._method.poly_coeff_z:
-                    coeff_z = stage._method.poly_coeff_z[k * M + l]
-                    tpower_z = hcat([constpow(ts,i) for i in range(coeff_z.shape[1])]).T
-                    z = mtimes(coeff_z,tpower_z)
-                else:
-                    z = nan
-
-                pv = stage._method.get_p_sys(stage,k)
-                sub_expr.append(stage._method.eval_at_integrator(stage, expr_f(local_t.T, mtimes(coeff,tpower), z, stage._method.U[k], pv, stage._method.t0, stage._method.T), k, l))
-                t0+=dt
-
-        ts = tlocal[-1,:]
-        total_time.append(time[k+1])
-        tpower = hcat([constpow(ts,i) for i in range(coeff.shape[1])]).T
-        if stage._method.poly_coeff_z:
-            tpower_z = hcat([constpow(ts,i) for i in range(coeff_z.shape[1])]).T
-            z = mtimes(coeff_z,tpower_z)
-        else:
-            z = nan
-
-        pv = stage._method.get_p_sys(stage,-1)
-        sub_expr.append(stage._method.eval_at_integrator(stage, expr_f(time[k+1], mtimes(stage._method.poly_coeff[-1],tpower), z, stage._method.U[-1], pv, stage._method.t0, stage._method.T), k, l))
-
-        return vcat(total_time), hcat(sub_expr)
+                t0s.append(time[k]+l*h)
+                dts.append(h)
+                us.append(method.U[k])
+                ps.append(pv)
+        t0_row, dt_row = hcat(t0s), hcat(dts)
+        args = [t0_row, dt_row, method.poly_coeff.hcat(), hcat(us), hcat(ps), method.t0, method.T]
+        if has_z:
+            args.append(method.poly_coeff_z.hcat())
+        sub_expr = [interval(np.linspace(0, 1, refine+1)[:-1]).map(N*M)(*args)]
+        total_time = [vec(repmat(t0_row, refine, 1)+mtimes(DM(np.linspace(0, 1, refine+1)[:-1]), dt_row)), time[N]]
+
+        # End point: end of the last integration interval
+        args = [t0s[-1], dts[-1], method.poly_coeff[-1], method.U[-1], method.get_p_sys(stage,-1), method.t0, method.T]
+        if has_z:
+            args.append(method.poly_coeff_z[-1])
+        sub_expr.append(interval([1])(*args))
+
+        # Interior and end point are in terms of transcribed symbols alike, up to top-level substitution
+        return vcat(total_time), stage.master._method.eval_top(stage.master, hcat(sub_expr))
 
     @transcribed
     def value(self, expr):
@@ -1574,19 +1757,14 @@ class Stage:
         ti = time[i]
         tlocal = t-ti
 
-        for c in self._method.poly_coeff:
-            assert c.shape == self._method.poly_coeff[0].shape
-
-        coeffs = hcat(self._method.poly_coeff)
-        s = self._method.poly_coeff[0].shape[1]
+        coeffs = self._method.poly_coeff.hcat()
+        s = self._method.poly_coeff.block_shape[1]
         coeff = coeffs[:,(i*s+DM(range(s)).T)]
 
         tpower = constpow(tlocal,range(s))
         if self._method.poly_coeff_z:
-            for c in self._method.poly_coeff_z:
-                assert c.shape == self._method.poly_coeff_z[0].shape
-            coeffs_z = hcat(self._method.poly_coeff_z)
-            s_z = self._method.poly_coeff_z[0].shape[1]
+            coeffs_z = self._method.poly_coeff_z.hcat()
+            s_z = self._method.poly_coeff_z.block_shape[1]
             coeff_z = coeffs_z[:,i*s_z+DM(range(s_z)).T]
             tpower_z = constpow(tlocal,range(s_z))
             z = mtimes(coeff_z,tpower_z)
@@ -1624,3 +1802,67 @@ class Stage:
             return wrapper
         else:
             return f
+
+    @transcribed
+    def polynomial_sampler(self, exprs, gist):
+        """Returns a purely numerical sampler for given expressions
+
+        In contrast to :meth:`sampler`, all coefficients are extracted
+        from the gist once. Subsequent calls do not involve CasADi,
+        and write into a caller-provided buffer.
+
+        Parameters
+        ----------
+        exprs : :obj:`casadi.MX` or list of :obj:`casadi.MX`
+            Expressions affine in time, states, algebraic states and controls
+        gist : float vector
+            The gist of the solution, provided from `sol.gist` or
+            the evaluation of `ocp.gist`
+
+        Returns
+        -------
+        :obj:`~rockit.polynomial_sampler.PolynomialSampler`
+            (t, out=None) -> output of shape (n,) for scalar t, (len(t), n) for vector t,
+            with n the total number of entries in exprs
+
+        """
+        from .polynomial_sampler import PolynomialSampler
+        if not isinstance(exprs, list):
+            exprs = [exprs]
+        if self._method.poly_coeff is None:
+            msg = "No polynomal coefficients for the {} integration method".format(self._method.intg)
+            raise Exception(msg)
+        N, M = self._method.N, self._method.M
+
+        e = veccat(*exprs)
+        expr_f = Function('expr', [self.t, self.x, self.z, self.u], [e])
+        assert not expr_f.has_free()
+        syms = vertcat(self.t, self.x, self.z, self.u)
+        if not is_linear(e, syms):
+            raise Exception("polynomial_sampler requires expressions that are affine in time, states, algebraic states and controls.")
+        J = np.array(evalf(jacobian(e, syms)))
+        b = np.array(evalf(substitute(e, syms, DM.zeros(syms.sparsity())))).ravel()
+        J_t, J_x, J_z, J_u = np.split(J, np.cumsum([1, self.nx, self.nz]), axis=1)
+
+        s = self._method.poly_coeff.block_shape[1]
+        has_z = bool(self._method.poly_coeff_z)
+        s_z = self._method.poly_coeff_z.block_shape[1] if has_z else 0
+        data = Function('data', [self.gist], [vcat(self._method.integrator_grid), self._method.poly_coeff.hcat(),
+                                              self._method.poly_coeff_z.hcat() if has_z else DM(self.nz, 0), hcat(self._method.U)])
+        grid, cx, cz, U = [np.array(v) for v in data(gist)]
+        n = N*M
+
+        degree = max(s, s_z, 2 if np.any(J_t) else 1)
+        coeffs = np.zeros((degree, n, e.numel()))
+        coeffs[:s] = np.einsum('oi,ikj->jko', J_x, cx.reshape(self.nx, n, s))
+        if has_z:
+            coeffs[:s_z] += np.einsum('oi,ikj->jko', J_z, cz.reshape(self.nz, n, s_z))
+        elif np.any(J_z):
+            coeffs[:, :, np.any(J_z, axis=1)] = nan
+        grid = grid.ravel()
+        coeffs[0] += (J_u @ U.reshape(self.nu, N)).T[np.arange(n)//M]
+        coeffs[0] += np.outer(grid[:-1], J_t[:, 0])
+        if degree>1:
+            coeffs[1] += J_t[:, 0]
+        coeffs[0] += b
+        return PolynomialSampler(grid, coeffs)
@@ -1,4 +1,5 @@
 from rockit import Ocp, DirectMethod, MultipleShooting, FreeTime
+from casadi import vertcat
 
 
 def integrator_control_problem(T=1, u_max=1, x0=0, stage_method=None, t0=0):
@@ -140,3 +141,37 @@ def vdp(method,grid='control'):
   # Pick a solution method
   ocp.method(method)
   return (ocp, x1, x2, u)
+
+def duffing(method, T=3, u_max=1):
+  ocp = Ocp(T=T)
+
+  # Define 1 vector-valued state
+  x = ocp.state(2)
+
+  # Define 1 control
+  u = ocp.control()
+
+  # Stiffness and initial state as parameters
+  b = ocp.parameter()
+  x0 = ocp.parameter(2)
+  ocp.set_value(b, 0.1)
+  ocp.set_value(x0, vertcat(1, 0))
+
+  # Specify ODE
+  ocp.set_der(x, vertcat(x[1], u-b*x[0]**3))
+
+  # Lagrange objective
+  ocp.add_objective(ocp.integral(x[0]**2+u**2))
+
+  # Path constraints
+  ocp.subject_to(-u_max <= (u <= u_max))
+
+  # Initial constraints
+  ocp.subject_to(ocp.at_t0(x) == x0)
+
+  # Pick an NLP solver backend
+  ocp.solver('ipopt')
+
+  # Pick a solution method
+  ocp.method(method)
+  return (ocp, x, u, b, x0)
@@ -3,8 +3,10 @@ import unittest
 from pylab import *
 
 from rockit import Ocp, DirectMethod, MultipleShooting, DirectCollocation, SingleShooting, SplineMethod
-from problems import integrator_control_problem, bang_bang_chain_problem
+from problems import integrator_control_problem, bang_bang_chain_problem, vdp, duffing
 import numpy as np
+from casadi import vertcat
+from numpy.testing import assert_array_almost_equal
 
 class MethodTests(unittest.TestCase):
 
@@ -44,5 +46,155 @@ class MethodTests(unittest.TestCase):
         
 
         
+    def test_multiple_shooting_vectorize(self):
+      for kwargs in [dict(N=6,M=2,intg='rk'), dict(N=6,intg='collocation')]:
+        res = []
+        for options in [dict(vectorize=False), dict(vectorize=True), dict(parallelization='thread', max_num_threads=2)]:
+          ocp, x1, x2, u = vdp(MultipleShooting(**options, **kwargs))
+          sol = ocp.solve()
+          res.append((sol.sample(x1, grid='integrator')[1], sol.sample(u, grid='control')[1], ocp._method.opti.ng))
+
+        for r in res[1:]:
+          assert_array_almost_equal(res[0][0],r[0],decimal=10)
+          assert_array_almost_equal(res[0][1],r[1],decimal=10)
+          self.assertEqual(res[0][2],r[2])
+
+      with self.assertRaises(Exception):
+        MultipleShooting(parallelization='gpu')
+
+    def test_poly_coeff_blocks(self):
+      ref = None
+      for method in [MultipleShooting(N=4, M=3), MultipleShooting(N=4, M=3, vectorize=True), SingleShooting(N=4, M=3)]:
+        ocp = Ocp(T=2)
+        x = ocp.state()
+        u = ocp.control()
+        ocp.set_der(x, u-x)
+        ocp.subject_to(ocp.at_t0(x)==1)
+        ocp.add_objective(ocp.integral(x**2+u**2))
+        ocp.solver('ipopt')
+        ocp.method(method)
+        sol = ocp.solve()
+        coeffs = ocp._method.poly_coeff
+        self.assertEqual(len(coeffs), 12)
+        self.assertEqual(coeffs.block_shape, (1, 5))
+        self.assertEqual(len(coeffs._chunks), 1 if getattr(method, "vectorize", False) else 4)
+        assert_array_almost_equal(sol.value(coeffs[-1]), sol.value(coeffs.hcat()[:, -5:]))
+        s = sol.sampler(x)(np.linspace(0, 2, 13))
+        if ref is None: ref = s
+        assert_array_almost_equal(s, ref)
+
+    def test_inf_constraints_degree(self):
+      from rockit.sampling_method import bernstein_conversion
+      assert_array_almost_equal(bernstein_conversion(4)[1], [[1,0,0,0,0],[1,1.0/4, 0, 0, 0],[1, 1.0/2, 1.0/6, 0, 0],[1, 3.0/4, 1.0/2, 1.0/4, 0],[1, 1, 1, 1, 1]])
+      self.assertIs(bernstein_conversion(3), bernstein_conversion(3))
+      for method in [MultipleShooting(N=6, intg='rk'), MultipleShooting(N=6, intg='expl_euler'), DirectCollocation(N=6, degree=2), DirectCollocation(N=6, degree=5)]:
+        ocp = Ocp(T=1)
+        p = ocp.state()
+        v = ocp.state()
+        u = ocp.control()
+        ocp.set_der(p, v)
+        ocp.set_der(v, u)
+        ocp.subject_to(ocp.at_t0(p)==0)
+        ocp.subject_to(ocp.at_t0(v)==0)
+        ocp.subject_to(ocp.at_tf(p)==1)
+        ocp.subject_to(ocp.at_tf(v)==0)
+        ocp.subject_to(v<=1.3, grid='inf')
+        ocp.add_objective(ocp.integral(u**2))
+        ocp.solver('ipopt')
+        ocp.method(method)
+        sol = ocp.solve()
+        _, vs = sol.sample(v, grid='integrator', refine=20)
+        self.assertLessEqual(np.max(vs), 1.3+1e-6)
+        self.assertGreater(np.max(vs), 1.2)
+
+    def test_stagewise_solver(self):
+      ref = None
+      for solver, vectorize in [('ipopt', False), ('fatrop', False), ('fatrop', True)]:
+        ocp, x, u, b, x0 = duffing(MultipleShooting(N=20, vectorize=vectorize), T=5)
+        ocp.subject_to(x[1]>=-0.4)
+        ocp.solver(solver)
+        sol = ocp.solve()
+        xs = sol.sample(x, grid='control')[1]
+        if ref is None: ref = xs
+        assert_array_almost_equal(xs, ref, decimal=5)
+
+      # Switching solvers after a transcription
+      ocp, x, u, b, x0 = duffing(MultipleShooting(N=20, vectorize=True), T=5)
+      ocp.subject_to(x[1]>=-0.4)
+      ocp.solve()
+      n_at_once = len(ocp._method.opti.constraints)
+      ocp.solver('fatrop')
+      sol = ocp.solve()
+      self.assertEqual(len(ocp._method.opti.constraints), n_at_once+19)
+      assert_array_almost_equal(sol.sample(x, grid='control')[1], ref, decimal=5)
+
+      # The solver is declared on the master of a child stage
+      ocp = Ocp()
+      stage = ocp.stage(t0=0, T=5)
+      x = stage.state(2)
+      u = stage.control()
+      stage.set_der(x, vertcat(x[1], u-0.1*x[0]**3))
+      stage.subject_to(stage.at_t0(x)==vertcat(1, 0))
+      stage.subject_to(-1 <= (u <= 1))
+      stage.subject_to(x[1]>=-0.4)
+      stage.add_objective(stage.integral(x[0]**2+u**2))
+      stage.method(MultipleShooting(N=20, vectorize=True))
+      ocp.solver('fatrop')
+      sol = ocp.solve()
+      self.assertEqual(len(ocp._method.opti.constraints), n_at_once+19)
+      assert_array_almost_equal(sol(stage).sample(x, grid='control')[1], ref, decimal=5)
+
+    def test_condense_block(self):
+      ref = None
+      for condense_block in [1, 3, 5]:
+        ocp, x, u, b, x0 = duffing(MultipleShooting(N=12, condense_block=condense_block), T=5)
+        ocp.subject_to(x[1]>=-0.4)
+        ocp.set_initial(x, vertcat(1, 0))
+        sol = ocp.solve()
+        n_nodes = len(range(0, 12, condense_block))+1
+        self.assertEqual(ocp._method.opti.nx, 12+2*n_nodes)
+        xs = sol.sample(x, grid='control')[1]
+        if ref is None: ref = xs
+        assert_array_almost_equal(xs, ref, decimal=5)
+      with self.assertRaises(Exception):
+        MultipleShooting(N=12, condense_block=3, vectorize=True)
+
+    def test_shared_discrete_system(self):
+      from rockit import Stage
+      template = Stage(T=1)
+      x = template.state()
+      u = template.control()
+      delta = template.parameter()
+      template.set_der(x, -x+u+delta)
+      template.add_objective(template.integral(x**2+u**2))
+      template.method(MultipleShooting(N=5, intg='rk'))
+
+      ocp = Ocp()
+      stages = []
+      for i, d in enumerate([-1, 0, 1]):
+        stage = ocp.stage(template, t0=0)
+        stage.set_value(delta, d)
+        ocp.subject_to(stage.at_t0(x)==1)
+        stages.append(stage)
+      other = ocp.stage(T=1)
+      y = other.state()
+      other.set_der(y, -2*y)
+      other.subject_to(other.at_t0(y)==1)
+      other.method(MultipleShooting(N=5, intg='rk'))
+      ocp.solver('ipopt')
+      sol = ocp.solve()
+
+      self.assertEqual(len(ocp._method.opti.discrete_system_cache), 2)
+      for stage, d in zip(stages, [-1, 0, 1]):
+        ref = Ocp(T=1)
+        xr = ref.state()
+        ur = ref.control()
+        ref.set_der(xr, -xr+ur+d)
+        ref.add_objective(ref.integral(xr**2+ur**2))
+        ref.subject_to(ref.at_t0(xr)==1)
+        ref.method(MultipleShooting(N=5, intg='rk'))
+        ref.solver('ipopt')
+        assert_array_almost_equal(sol(stage).sample(x, grid='control')[1], ref.solve().sample(xr, grid='control')[1])
+
 if __name__ == '__main__':
     unittest.main()
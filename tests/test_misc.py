@@ -1,9 +1,9 @@
 from ast import Mult
 import unittest
 
-from rockit import Ocp, DirectMethod, MultipleShooting, FreeTime, DirectCollocation, SingleShooting, SplineMethod, UniformGrid, GeometricGrid, FreeGrid, LseGroup, rockit_pickle_context, rockit_unpickle_context
-from problems import integrator_control_problem, vdp, vdp_dae, bang_bang_problem
-from casadi import DM, jacobian, sum1, sum2, MX, rootfinder, evalf, sumsqr, symvar
+from rockit import Ocp, DirectMethod, MultipleShooting, FreeTime, DirectCollocation, SingleShooting, SplineMethod, UniformGrid, GeometricGrid, FreeGrid, LseGroup, MPCRunner, RTIRunner, rockit_pickle_context, rockit_unpickle_context
+from problems import integrator_control_problem, vdp, vdp_dae, bang_bang_problem, duffing
+from casadi import DM, jacobian, sum1, sum2, MX, rootfinder, evalf, sumsqr, symvar, substitute
 from numpy import sin, pi, linspace
 from numpy.testing import assert_array_almost_equal
 from rockit.splines.spline import Spline
@@ -450,6 +450,373 @@ class MiscTests(unittest.TestCase):
         assert_array_almost_equal(x2_a,x2_b,decimal=12)
         assert_array_almost_equal(u_a,u_b,decimal=12)
 
+    def test_incremental_transcription(self):
+      for method in [lambda: MultipleShooting(N=6,intg='rk'), lambda: MultipleShooting(N=6,intg='rk',vectorize=True),
+                     lambda: SingleShooting(N=6,intg='rk'), lambda: DirectCollocation(N=6)]:
+        ocp, x1, x2, u = vdp(method())
+        ocp.solve()
+        augmented = ocp._augmented
+        ng = ocp._method.opti.ng
+
+        ocp.subject_to(u >= -0.5)
+        ocp.add_objective(ocp.at_tf(x1)**2)
+        sol = ocp.solve()
+        self.assertIs(ocp._augmented, augmented)
+        self.assertEqual(ocp._method.opti.ng, ng+7)
+
+        ref, rx1, rx2, ru = vdp(method())
+        ref.subject_to(ru >= -0.5)
+        ref.add_objective(ref.at_tf(rx1)**2)
+        sol_ref = ref.solve()
+        assert_array_almost_equal(sol.sample(u, grid='control')[1], sol_ref.sample(ru, grid='control')[1], decimal=8)
+        self.assertEqual(ocp._method.opti.ng, ref._method.opti.ng)
+
+        ocp.clear_constraints()
+        ocp.subject_to(-1 <= (u <= 1))
+        ocp.subject_to(ocp.at_t0(x1) == 0)
+        ocp.subject_to(ocp.at_t0(x2) == 1)
+        sol = ocp.solve()
+        self.assertIs(ocp._augmented, augmented)
+
+        ref, rx1, rx2, ru = vdp(method())
+        ref.clear_constraints()
+        ref.subject_to(-1 <= (ru <= 1))
+        ref.subject_to(ref.at_t0(rx1) == 0)
+        ref.subject_to(ref.at_t0(rx2) == 1)
+        ref.add_objective(ref.at_tf(rx1)**2)
+        sol_ref = ref.solve()
+        assert_array_almost_equal(sol.sample(u, grid='control')[1], sol_ref.sample(ru, grid='control')[1], decimal=8)
+        self.assertEqual(ocp._method.opti.ng, ref._method.opti.ng)
+
+      # Extending the state space requires a full transcription
+      ocp, x1, x2, u = vdp(MultipleShooting(N=6,intg='rk'))
+      ocp.solve()
+      augmented = ocp._augmented
+      ocp.add_objective(ocp.integral(u**2))
+      sol = ocp.solve()
+      self.assertIsNot(ocp._augmented, augmented)
+      ref, rx1, rx2, ru = vdp(MultipleShooting(N=6,intg='rk'))
+      ref.add_objective(ref.integral(ru**2))
+      assert_array_almost_equal(sol.sample(u, grid='control')[1], ref.solve().sample(ru, grid='control')[1], decimal=8)
+
+    def test_solver_cache(self):
+      from rockit.direct_method import solver_cache
+      solver_cache.clear()
+
+      def problem(bound, cache=True):
+        ocp, x1, x2, u = vdp(MultipleShooting(N=6,intg='rk'))
+        p = ocp.parameter()
+        ocp.subject_to(u >= -p)
+        ocp.set_value(p, bound)
+        ocp.solver('ipopt', cache=cache)
+        return ocp, u
+
+      res = []
+      for bound in [0.5, 1, 0.5]:
+        ocp, u = problem(bound)
+        sol = ocp.solve()
+        self.assertEqual(len(solver_cache), 1)
+        ref, ru = problem(bound, cache=False)
+        sol_ref = ref.solve()
+        assert_array_almost_equal(sol.sample(u, grid='control')[1], sol_ref.sample(ru, grid='control')[1], decimal=8)
+        self.assertAlmostEqual(sol.value(ocp.objective), sol_ref.value(ref.objective))
+        # Assignment expressions overrule solution values
+        ps = symvar(ocp._method.opti.p)[0]
+        self.assertAlmostEqual(sol.sol.value(2*ps, [ps==3]), 6)
+      self.assertIsNotNone(ocp._method.opti._cached_solver)
+
+      # Structural change
+      ocp, u = problem(1)
+      ocp.subject_to(u <= 0.9)
+      ocp.solve()
+      self.assertEqual(len(solver_cache), 2)
+
+      solver_cache.capacity = 1
+      ocp, u = problem(1)
+      ocp.subject_to(u <= 0.8)
+      ocp.solve()
+      self.assertEqual(len(solver_cache), 1)
+      solver_cache.capacity = 16
+      solver_cache.clear()
+
+    def test_solver_cache_dir(self):
+      from rockit.direct_method import solver_cache
+      import tempfile, os
+      solver_cache.clear()
+      with tempfile.TemporaryDirectory() as cache_dir:
+        res = []
+        for i in range(2):
+          ocp, x1, x2, u = vdp(MultipleShooting(N=6,intg='rk'))
+          ocp.solver('ipopt', cache_dir=cache_dir)
+          res.append(ocp.solve().sample(u, grid='control')[1])
+          self.assertEqual(len([f for f in os.listdir(cache_dir) if f.endswith(".casadi")]), 1)
+          # Mimic a fresh process
+          solver_cache.clear()
+        self.assertIsNotNone(ocp._method.opti._cached_solver)
+        assert_array_almost_equal(res[0], res[1], decimal=10)
+
+    def test_parameter_setter(self):
+      def problem():
+        ocp, x1, x2, u = vdp(MultipleShooting(N=6,intg='rk'))
+        p = ocp.parameter()
+        w = ocp.parameter(grid='control')
+        ocp.subject_to(u >= -p)
+        ocp.subject_to(x1 <= w)
+        ocp.set_value(p, 1)
+        ocp.set_value(w, 10)
+        return ocp, p, w, u
+
+      ocp, p, w, u = problem()
+      setter = ocp.parameter_setter([p, w])
+      ref, rp, rw, ru = problem()
+      for pv, wv in [(0.5, 10), (0.8, np.linspace(0.9, 1.5, 6).reshape(1, 6)), (1, 0.8)]:
+        setter(pv, wv)
+        ref.set_value(rp, pv)
+        ref.set_value(rw, wv)
+        assert_array_almost_equal(ocp.solve().sample(u, grid='control')[1], ref.solve().sample(ru, grid='control')[1], decimal=8)
+
+      # New transcription
+      ocp.add_objective(ocp.integral(u**2))
+      ref.add_objective(ref.integral(ru**2))
+      setter(0.5, 10)
+      ref.set_value(rp, 0.5)
+      ref.set_value(rw, 10)
+      assert_array_almost_equal(ocp.solve().sample(u, grid='control')[1], ref.solve().sample(ru, grid='control')[1], decimal=8)
+
+      # Values are retained by a full transcription
+      setter(0.01, 0.9)
+      ref.set_value(rp, 0.01)
+      ref.set_value(rw, 0.9)
+      ocp.method(MultipleShooting(N=6,intg='rk'))
+      assert_array_almost_equal(ocp.solve().sample(u, grid='control')[1], ref.solve().sample(ru, grid='control')[1], decimal=8)
+
+      with self.assertRaisesRegex(Exception, "non-parameter"):
+        ocp.parameter_setter([u])
+      with self.assertRaises(Exception):
+        setter(1)
+      with self.assertRaises(Exception):
+        setter(1, np.ones((1, 3)))
+
+    def test_mpc_runner(self):
+      for method in [MultipleShooting(N=10), DirectCollocation(N=10), SingleShooting(N=10)]:
+        ocp, x, u, b, x0 = duffing(method)
+        ocp.solver('ipopt', {"ipopt.warm_start_init_point": "yes"})
+
+        mpc = MPCRunner(ocp, x0)
+        with self.assertRaisesRegex(Exception, "forgot to solve"):
+          mpc.solution
+        xk = np.array([1, 0.])
+        buffer = None
+        for i in range(3):
+          u0 = mpc(xk)
+          if buffer is None: buffer = u0
+          self.assertIs(u0, buffer)
+          ocp.set_value(x0, xk)
+          ref = ocp.solve().sample(u, grid='control')[1][0]
+          self.assertAlmostEqual(u0[0], ref, 6)
+          self.assertAlmostEqual(mpc.solution.sample(u, grid='control')[1][0], u0[0], 8)
+          xk = xk + 0.3*np.array([xk[1], u0[0]-0.1*xk[0]**3])
+
+    def test_rti_runner(self):
+      ocp, x, u, b, x0 = duffing(MultipleShooting(N=10))
+      x_meas = np.array([0.5, 0.2])
+      ocp.set_value(x0, x_meas)
+      ref = ocp.solve().sample(u, grid='control')[1][0]
+
+      # Without shifting, repeated real-time iterations are full SQP steps
+      rti = RTIRunner(ocp, x0, shift=False)
+      for i in range(6):
+        u0 = rti(x_meas)
+      self.assertAlmostEqual(u0[0], ref, 6)
+      self.assertAlmostEqual(rti.solution.sample(u, grid='control')[1][0], u0[0], 8)
+
+      rti = RTIRunner(ocp, x0)
+      rti.prepare()
+      self.assertIs(rti.feedback(x_meas), rti.u)
+
+    def test_solve_batch(self):
+      ocp, x, u, b, x0 = duffing(MultipleShooting(N=10), u_max=0.7)
+      ocp.set_value(b, 0.5)
+      bs = np.array([0, 0.5, np.nan, 1])
+      us = ocp.sample(u, grid='control')[1]
+      res, stats = ocp.solve_batch({b: bs}, {ocp.sample(x, grid='control')[1]: np.ones((4, 2, 11))}, results={"u": us})
+      self.assertEqual(res["u"].shape, (4, 11))
+      self.assertEqual([s["success"] for s in stats], [True, True, False, True])
+      res_par, stats_par = ocp.solve_batch({b: bs}, workers=2)
+      self.assertEqual([s["success"] for s in stats_par], [True, True, False, True])
+      for i in [0, 1, 3]:
+        ocp.set_value(b, bs[i])
+        sol = ocp.solve()
+        assert_array_almost_equal(res["u"][i], sol.sample(u, grid='control')[1])
+        assert_array_almost_equal(ocp.sampler(u)(res_par["gist"][i], 1.0), sol.sampler(u)(1.0))
+      with self.assertRaisesRegex(Exception, "number of instances"):
+        ocp.solve_batch({})
+
+    def test_set_initial_batched(self):
+      for method in [MultipleShooting(N=8), DirectCollocation(N=8), SingleShooting(N=8)]:
+        ocp, x1, x2, u = vdp(method)
+        ocp.set_initial(u, np.linspace(0, 1, 8))
+        if not isinstance(method, SingleShooting):
+          ocp.set_initial(x1, sin(ocp.t))
+          ocp.set_initial(x2, 0.5)
+          tgrid = np.linspace(0, 10, 9)
+          assert_array_almost_equal(ocp.initial_value(ocp.sample(x1, grid='control')[1]), sin(tgrid))
+          assert_array_almost_equal(ocp.initial_value(ocp.sample(x2, grid='control')[1]), 0.5*np.ones(9))
+        assert_array_almost_equal(ocp.initial_value(ocp.sample(u, grid='control')[1])[:-1], np.linspace(0, 1, 8))
+
+    def test_substitution_plan(self):
+      ocp, x1, x2, u = vdp(MultipleShooting(N=4, M=2))
+      ocp.set_initial(x1, ocp.t)
+      ocp.set_initial(u, np.array([[0.1, 0.2, 0.3, 0.4]]))
+      expr = sin(x1)*u + ocp.t
+      tgrid = np.linspace(0, 10, 5)
+      ref = np.sin(tgrid)*np.array([0.1, 0.2, 0.3, 0.4, 0.4]) + tgrid
+      # First evaluation substitutes, subsequent ones go through a compiled plan
+      for i in range(3):
+        assert_array_almost_equal(ocp.initial_value(ocp.sample(expr, grid='control')[1]), ref)
+      self.assertTrue(ocp._transcribed._method._subst_plans)
+
+    def test_placeholders_closure(self):
+      from rockit.placeholders import TranscribedPlaceholders
+      x = MX.sym("x")
+      r1 = MX.sym("r1")
+      r2 = MX.sym("r2")
+      r3 = MX.sym("r3")
+      placeholders = TranscribedPlaceholders()
+      placeholders[2][r1] = {"normal": r2+1}
+      placeholders[2][r2] = {"normal": 2*r3}
+      placeholders[1][r3] = {"normal": x**2}
+      f = lambda e: float(evalf(substitute(placeholders(e), x, 3)))
+      self.assertEqual(f(r1*r2), 19*18)
+      self.assertEqual(f(r3), 9)
+      self.assertEqual(f(r3), 9)
+      self.assertEqual(placeholders(x), x)
+
+      # New placeholders extend the closure
+      r4 = MX.sym("r4")
+      placeholders[2][r4] = {"normal": r1+x}
+      placeholders.mark_dirty()
+      self.assertEqual(f(r4), 22)
+      placeholders[2][r3] = {"normal": x}
+      self.assertEqual(f(r4), 10)
+      # Reassigned values are picked up without mark_dirty
+      placeholders[2][r3] = {"normal": x+1}
+      self.assertEqual(f(r4), 12)
+
+      placeholders = TranscribedPlaceholders()
+      placeholders[1][r1] = {"normal": r2+1}
+      placeholders[1][r2] = {"normal": r1}
+      with self.assertRaisesRegex(Exception, "Cyclic"):
+        placeholders(r1, max_phase=1)
+
+    def test_template_shared_dynamics(self):
+      from rockit import Stage
+      template = Stage(T=1)
+      x = template.state()
+      u = template.control()
+      template.set_der(x, -x+u)
+      template.add_objective(template.integral(x**2+u**2))
+      template.method(MultipleShooting(N=4, intg='rk'))
+
+      ocp = Ocp()
+      clones = [ocp.stage(template) for i in range(3)]
+      altered = ocp.stage(template)
+      altered.set_der(x, -2*x+u)
+      for stage in clones:
+        self.assertIs(stage._ode(), template._ode())
+      self.assertIsNot(altered._ode(), template._ode())
+
+      f = template._ode()
+      template.set_der(x, -3*x+u)
+      self.assertIsNot(template._ode(), f)
+      self.assertIs(clones[0]._ode(), f)
+
+      for stage in clones+[altered]:
+        ocp.subject_to(stage.at_t0(x)==1)
+      ocp.solver('ipopt')
+      sol = ocp.solve()
+
+      # One discretised system for the unaltered clones, one for the altered one
+      F = [stage._method.discrete_system(stage) for stage in ocp._transcribed._stages]
+      self.assertTrue(F[0] is F[1] is F[2])
+      self.assertIsNot(F[0], F[3])
+      self.assertEqual(len([k for k in template._var_dynamics_cache if isinstance(k[0], tuple)]), 2)
+      assert_array_almost_equal(sol(clones[0]).sample(x, grid='control')[1], sol(clones[2]).sample(x, grid='control')[1])
+
+      # Stale dynamics of a re-declared template are evicted
+      template._dynamics_cache_capacity = 3
+      for i in range(10):
+        template.set_der(x, -i*x+u)
+        template._ode()
+      self.assertEqual(len(template._var_dynamics_cache), 3)
+      self.assertIs(template._ode(), template._ode())
+
+    def test_augmented_structural_sharing(self):
+      ocp = Ocp(T=1)
+      x = ocp.state()
+      u = ocp.control()
+      ocp.set_der(x, -x+u)
+      ocp.subject_to(ocp.at_t0(x)==1)
+      ocp.add_objective(ocp.integral(x**2+u**2))
+      stage = ocp.stage(T=1)
+      y = stage.state()
+      stage.set_der(y, -y)
+      stage.subject_to(stage.at_t0(y)==1)
+      stage.method(MultipleShooting(N=3))
+      ocp.method(MultipleShooting(N=4))
+      ocp.solver('ipopt')
+      ocp.solve()
+
+      augmented = ocp._augmented
+      self.assertIsNot(augmented, ocp)
+      self.assertIs(augmented._stages[0]._var_original, stage)
+      self.assertIs(augmented._stages[0].parent, augmented)
+      self.assertIs(augmented._stages[0].master, augmented)
+      # Containers mutated by augmentation are copies
+      self.assertEqual(len(ocp.qstates), 0)
+      self.assertEqual(len(augmented.qstates), 1)
+      self.assertIsNot(augmented._meta, ocp._meta)
+      # Contents are shared
+      self.assertIs(augmented.states[0], ocp.states[0])
+      self.assertIs(augmented._meta[x], ocp._meta[x])
+      self.assertIs(augmented._state_der[x], ocp._state_der[x])
+      self.assertIs(augmented._method, ocp._method)
+
+    def test_debug_meta(self):
+      import os
+      from rockit import set_debug_meta
+      def build(**kwargs):
+        ocp = Ocp(T=1, **kwargs)
+        x = ocp.state()
+        u = ocp.control()
+        ocp.set_der(x, -x+u)
+        ocp.subject_to(-1<=(u<=1))
+        ocp.subject_to(ocp.at_t0(x)==1)
+        ocp.add_objective(ocp.integral(x**2))
+        ocp.method(MultipleShooting(N=4))
+        ocp.solver('ipopt')
+        return ocp, x
+      ocp, x = build()
+      ref = ocp.solve().sample(x, grid='control')[1]
+      self.assertIn(__file__, ocp._meta[x]["stacktrace"][0]["file"])
+      self.assertIn(__file__, ocp._method.opti.constraints[0][2]["stacktrace"][0]["file"])
+
+      ocp, x = build(debug_meta=False)
+      self.assertEqual(ocp._meta[x]["stacktrace"], [])
+      assert_array_almost_equal(ocp.solve().sample(x, grid='control')[1], ref)
+      opti = ocp._method.opti
+      self.assertEqual(opti.constraints[0][2]["stacktrace"], [])
+      self.assertNotIn(os.path.basename(__file__), opti.debug.g_describe(0))
+
+      set_debug_meta(False)
+      try:
+        ocp, x = build()
+        self.assertEqual(ocp._meta[x]["stacktrace"], [])
+        ocp, x = build(debug_meta=True)
+        self.assertEqual(len(ocp._meta[x]["stacktrace"]), 2)
+      finally:
+        set_debug_meta(True)
+
 
     def test_dae_methods(self):
      
@@ -1,9 +1,9 @@
 import unittest
 import numpy as np
-from numpy.testing import assert_allclose
-from problems import integrator_control_problem, bang_bang_problem
-from casadi import vertcat, DM, hcat
-from rockit import MultipleShooting, DirectCollocation, Ocp, SingleShooting, SplineMethod
+from numpy.testing import assert_allclose, assert_array_almost_equal
+from problems import integrator_control_problem, bang_bang_problem, vdp, duffing
+from casadi import vertcat, DM, hcat, horzcat, sin
+from rockit import MultipleShooting, DirectCollocation, Ocp, SingleShooting, SplineMethod, FreeTime
 
 class OcpSolutionTests(unittest.TestCase):
     def test_grid_integrator(self):
@@ -125,5 +125,132 @@ class OcpSolutionTests(unittest.TestCase):
           assert_allclose(sampler_numpy2_sol(t), X)
           assert_allclose(sampler_numpy1_sol(t)[0], X)
 
+    def test_sensitivity_predict(self):
+      ocp, x, u, b, x0 = duffing(MultipleShooting(N=10), u_max=0.7)
+      ocp.subject_to(x[0]>=-0.1)
+      ocp.set_value(b, 0.5)
+      ocp.solver('ipopt', {"ipopt.tol": 1e-10, "ipopt.warm_start_init_point": "yes"})
+      sol = ocp.solve()
+      u_ref = sol.sample(u, grid='control')[1]
+      dx, dlam_g = sol.sensitivity(b)
+      pred = sol.predict({b: 0.51})
+
+      ocp.set_value(b, 0.51)
+      sol2 = ocp.solve()
+      x_nlp = sol.sol.opti_wrapper.advanced.x
+      assert_array_almost_equal(dx[:, 0], (sol2.value(x_nlp)-sol.value(x_nlp))/0.01, decimal=2)
+      u_new = sol2.sample(u, grid='control')[1]
+      self.assertLess(np.linalg.norm(pred.sample(u, grid='control')[1]-u_new), 0.01*np.linalg.norm(u_ref-u_new))
+
+    def test_sample_cache(self):
+      ocp, x1, x2, u = vdp(MultipleShooting(N=10))
+      p = ocp.parameter()
+      ocp.set_value(p, 1)
+      ocp.add_objective(p*ocp.at_tf(x1**2))
+      sol = ocp.solve()
+      for grid, kwargs in [('control', {}), ('integrator', {}), ('integrator', {'refine': 3})]:
+        for expr in [x1, x1*u+p, ocp.t]:
+          t, r = ocp.sample(expr, grid=grid, **kwargs)
+          for i in range(2):
+            ts, rs = sol.sample(expr, grid=grid, **kwargs)
+            assert_array_almost_equal(ts, sol.sol.value(t))
+            assert_array_almost_equal(rs, sol.sol.value(r))
+      self.assertEqual(len(ocp._method.opti.sample_cache), 9)
+
+      # Freshly built expressions and numbers do not take up cache entries
+      for i in range(2):
+        assert_array_almost_equal(sol.sample(x1**2, grid='control')[1], sol.sample(x1, grid='control')[1]**2)
+        sol.sample(3, grid='control')
+      self.assertEqual(len(ocp._method.opti.sample_cache), 9)
+
+      # Least recently used samplers are evicted
+      stage = ocp._transcribed
+      stage._sample_cache_capacity = 2
+      sol.sample(x2, grid='control')
+      self.assertEqual(len(ocp._method.opti.sample_cache), 2)
+
+      # A new transcription invalidates the cache
+      ocp.subject_to(ocp.at_tf(x2)==0)
+      sol = ocp.solve()
+      ts, rs = sol.sample(x2, grid='control')
+      self.assertAlmostEqual(rs[-1], 0)
+
+    def test_sample_many(self):
+      ocp, x1, x2, u = vdp(MultipleShooting(N=10))
+      sol = ocp.solve()
+      exprs = {"x1": x1, "x": vertcat(x1, x2), "M": horzcat(vertcat(x1, u), vertcat(x2, 2*x1)), "t": ocp.t}
+      for grid, kwargs in [('control', {}), ('integrator', {}), ('integrator', {'refine': 3})]:
+        t, res = sol.sample_many(exprs, grid=grid, **kwargs)
+        self.assertEqual(list(res.keys()), list(exprs.keys()))
+        for name, expr in exprs.items():
+          ts, rs = sol.sample(expr, grid=grid, **kwargs)
+          assert_array_almost_equal(t, ts)
+          self.assertEqual(res[name].shape, rs.shape)
+          assert_array_almost_equal(res[name], rs)
+
+    def test_grid_intg_fine(self):
+      for method in [MultipleShooting(N=5, M=2), DirectCollocation(N=5, M=2), SingleShooting(N=5)]:
+        ocp = Ocp(T=2)
+        x = ocp.state()
+        u = ocp.control()
+        p = ocp.parameter(grid='control')
+        ocp.set_der(x, ocp.t)
+        ocp.subject_to(ocp.at_t0(x)==0)
+        ocp.add_objective(ocp.integral(u**2))
+        ocp.set_value(p, np.linspace(1, 2, 5))
+        ocp.solver('ipopt')
+        ocp.method(method)
+        sol = ocp.solve()
+        t, xs = sol.sample(x, grid='integrator', refine=4)
+        assert_array_almost_equal(t, np.linspace(0, 2, 4*(5 if isinstance(method, SingleShooting) else 10)+1))
+        assert_array_almost_equal(xs, t**2/2)
+        t, ps = sol.sample(p*x, grid='integrator', refine=4)
+        assert_array_almost_equal(ps[:-1], np.repeat(np.linspace(1, 2, 5), len(t)//5)*t[:-1]**2/2)
+
+        # Signal in terms of integrator time, with free start time and horizon
+        ocp = Ocp(t0=FreeTime(0.5), T=FreeTime(1))
+        x = ocp.state()
+        u = ocp.control()
+        ocp.set_der(x, ocp.t+u)
+        ocp.subject_to(ocp.at_t0(x)==0)
+        ocp.subject_to(ocp.t0 >= 1)
+        ocp.subject_to(ocp.T >= 2)
+        ocp.add_objective(ocp.t0+ocp.T+ocp.integral(u**2))
+        ocp.solver('ipopt')
+        ocp.method(method)
+        sol = ocp.solve()
+        signal = x*ocp.T+sin(ocp.t)+ocp.t0
+        t, s = sol.sample(signal, grid='integrator', refine=4)
+        assert_array_almost_equal(t, np.linspace(1, 3, len(t)), decimal=6)
+        assert_array_almost_equal(s, (t**2-1)+np.sin(t)+1, decimal=6)
+        # Interior points and end point agree with the control grid
+        assert_array_almost_equal(s[::len(t)//5], sol.sample(signal, grid='control')[1], decimal=10)
+
+    def test_polynomial_sampler(self):
+      for method in [MultipleShooting(N=5, M=2), DirectCollocation(N=5, M=2)]:
+        ocp = Ocp(T=2)
+        x = ocp.state(2)
+        u = ocp.control()
+        ocp.set_der(x, vertcat(x[1], u-x[0]))
+        ocp.subject_to(ocp.at_t0(x)==vertcat(1, 0))
+        ocp.subject_to(-1<=(u<=1))
+        ocp.add_objective(ocp.integral(x[0]**2+u**2))
+        ocp.solver('ipopt')
+        ocp.method(method)
+        sol = ocp.solve()
+        exprs = [x, 3*x[0]-u+ocp.t+1]
+        s = sol.sampler(exprs)
+        p = sol.polynomial_sampler(exprs)
+        ts = np.linspace(-0.1, 2.1, 37)
+        ref = s(ts)
+        out = np.zeros((37, 3))
+        self.assertIs(p(ts, out=out), out)
+        assert_array_almost_equal(out, np.hstack([ref[0], ref[1][:, None]]))
+        out = np.zeros(3)
+        self.assertIs(p(0.77, out=out), out)
+        assert_array_almost_equal(out, np.hstack([s(0.77)[0], s(0.77)[1]]))
+        with self.assertRaises(Exception):
+          sol.polynomial_sampler(x[0]*u)
+
 if __name__ == '__main__':
     unittest.main()